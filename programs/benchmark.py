@@ -0,0 +1,751 @@
+import os
+import sys
+import time
+import json
+import random
+import sqlite3
+from shutil import copy, copytree, rmtree
+from contextlib import redirect_stdout
+from datetime import datetime
+from importlib.util import find_spec
+
+import utils
+import pipeline
+from utils import caption
+
+# Offline benchmarks of the hot paths of the pipeline.
+# They run on a synthetic corpus with the shape of the BHSA,
+# generated in a scratch directory, so no ~/github/etcbc checkout is needed.
+# Every run is saved as a JSON file, and compared with the previous run.
+#
+#   python benchmark.py [--scale books] [--repeat n] [--only name,name] [--verbose]
+
+benchDir = "_temp/bench"
+benchVersion = "b1"
+benchVersionNew = "b2"
+
+consonants = "BGDHWZXVJKLMNSPYQRCT<>"
+hebrew = dict(
+    zip(consonants, "בגדהוזחטיכלמנספצקרשתעא"),
+)
+vowels = "AEIOU"
+spValues = ("subs", "verb", "prep", "conj", "art", "nmpr", "adjv", "advb")
+functionValues = ("Pred", "Subj", "Objc", "Cmpl", "Conj", "Adju", "Time")
+phraseTypValues = ("NP", "VP", "PP", "CP", "PrNP", "AdvP")
+clauseTypValues = ("NmCl", "xQtX", "WayX", "Way0", "ZQtl", "InfC")
+
+
+def repoBenchDir():
+    return os.path.abspath(
+        "{}/../{}".format(os.path.dirname(os.path.abspath(__file__)), benchDir)
+    )
+
+
+def _spec(nodes):
+    # compact TF node specification: 1-3,5,7-8
+    parts = []
+    start = None
+    prev = None
+    for n in sorted(nodes):
+        if start is None:
+            start = n
+        elif n != prev + 1:
+            parts.append(str(start) if start == prev else "{}-{}".format(start, prev))
+            start = n
+        prev = n
+    if start is not None:
+        parts.append(str(start) if start == prev else "{}-{}".format(start, prev))
+    return ",".join(parts)
+
+
+def _esc(value):
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+
+def writeFeature(tfDir, name, version, data, valueType="str", edge=False, meta=None):
+    metaLines = ["@{}".format("edge" if edge else "node")]
+    metaLines.extend(
+        [
+            "@description=synthetic {} feature".format(name),
+            "@valueType={}".format(valueType),
+            "@version={}".format(version),
+            "@writtenBy=benchmark.py",
+        ]
+    )
+    for (key, value) in (meta or {}).items():
+        metaLines.append("@{}={}".format(key, value))
+    with open("{}/{}.tf".format(tfDir, name), "w") as fh:
+        fh.write("\n".join(metaLines) + "\n\n")
+        prev = None
+        for n in sorted(data):
+            value = data[n]
+            if prev is not None and n == prev + 1:
+                fh.write("{}\n".format(_esc(value)))
+            else:
+                fh.write("{}\t{}\n".format(n, _esc(value)))
+            prev = n
+
+
+def makeCorpus(base, version, scale=4, seed=1):
+    # scale is the number of books, the BHSA would be about scale=180
+    rng = random.Random(seed)
+
+    nChapters = 10
+    nVerses = 20
+
+    nLex = max(100, scale * 150)
+    lexemes = []
+    seen = set()
+    while len(lexemes) < nLex:
+        cons = "".join(rng.choice(consonants) for i in range(rng.randint(2, 4)))
+        sp = rng.choice(spValues)
+        lex = cons + ("[" if sp == "verb" else "/" if sp in {"subs", "nmpr"} else "")
+        lan = "arc" if rng.random() < 0.05 else "hbo"
+        while (lan, lex) in seen:
+            lex += "="
+        seen.add((lan, lex))
+        vocalized = "".join(c + rng.choice(vowels) for c in cons)
+        lexemes.append(
+            dict(
+                lex=lex,
+                lan=lan,
+                sp=sp,
+                cons=cons,
+                voc=vocalized,
+                heb="".join(hebrew[c] for c in cons),
+                vocHeb="".join(hebrew[c] + "\u05b8" for c in cons),
+                gloss="gloss {}".format(len(lexemes)),
+                root=cons[0:3],
+                nametype=rng.choice(("pers", "topo")) if sp == "nmpr" else None,
+                ls=rng.choice(("card", "ordn", "nmdi")) if rng.random() < 0.1 else None,
+            )
+        )
+    cumWeights = []
+    total = 0
+    for i in range(nLex):
+        total += 1 / (i + 1)
+        cumWeights.append(total)
+    lexRange = range(nLex)
+
+    # the sequence of word slots, grouped in books, chapters and verses
+
+    words = []
+    sections = []
+    for b in range(scale):
+        chapters = []
+        for c in range(nChapters):
+            verses = []
+            for v in range(nVerses):
+                start = len(words) + 1
+                for i in range(rng.randint(8, 16)):
+                    words.append(rng.choices(lexRange, cum_weights=cumWeights)[0])
+                verses.append((v + 1, list(range(start, len(words) + 1))))
+            chapters.append((c + 1, verses))
+        sections.append(("Book_{}".format(b + 1), chapters))
+    nWords = len(words)
+
+    # node types in canonical order, the slots of each object
+
+    objects = {
+        otype: []
+        for otype in (
+            "book",
+            "chapter",
+            "verse",
+            "sentence",
+            "sentence_atom",
+            "clause",
+            "clause_atom",
+            "phrase",
+            "phrase_atom",
+            "subphrase",
+        )
+    }
+    features = {}
+
+    def feat(name, n, value):
+        features.setdefault(name, {})[n] = value
+
+    for (book, chapters) in sections:
+        bookSlots = []
+        for (chapter, verses) in chapters:
+            chapterSlots = []
+            clausesInChapter = []
+            for (verse, slots) in verses:
+                chapterSlots.extend(slots)
+                objects["verse"].append((slots, dict(verse=verse)))
+
+                phrases = []
+                i = 0
+                while i < len(slots):
+                    size = rng.randint(1, 4)
+                    phrases.append(slots[i : i + size])
+                    i += size
+
+                clauses = []
+                i = 0
+                while i < len(phrases):
+                    size = rng.randint(1, 3)
+                    group = phrases[i : i + size]
+                    if len(group) == 3 and rng.random() < 0.2:
+                        # a discontinuous clause with an embedded clause
+                        clauses.append(group[0] + group[2])
+                        clauses.append(group[1])
+                    else:
+                        clauses.append([s for p in group for s in p])
+                    i += size
+                clausesInChapter.extend(clauses)
+
+                for p in phrases:
+                    info = dict(
+                        function=rng.choice(functionValues),
+                        typ=rng.choice(phraseTypValues),
+                        rela="NA",
+                        det=rng.choice(("det", "und")),
+                    )
+                    objects["phrase"].append((p, info))
+                    objects["phrase_atom"].append((p, dict(rela="NA")))
+                    if len(p) >= 2:
+                        objects["subphrase"].append(
+                            (p[0:2], dict(rela=rng.choice(("NA", "par", "atr"))))
+                        )
+                        if len(p) >= 3:
+                            objects["subphrase"].append((p[1:], dict(rela="NA")))
+
+            # sentences may cross verse boundaries
+            i = 0
+            while i < len(clausesInChapter):
+                size = rng.randint(1, 3)
+                s = sorted(x for c in clausesInChapter[i : i + size] for x in c)
+                objects["sentence"].append((s, {}))
+                objects["sentence_atom"].append((s, {}))
+                i += size
+            for c in clausesInChapter:
+                objects["clause"].append(
+                    (
+                        c,
+                        dict(
+                            rela="NA",
+                            typ=rng.choice(clauseTypValues),
+                            txt=rng.choice(("N", "Q", "?N", "NQ")),
+                        ),
+                    )
+                )
+                objects["clause_atom"].append(
+                    (
+                        c,
+                        dict(
+                            code=rng.randint(100, 999),
+                            tab=rng.randint(0, 12),
+                            pargr="{}.{}".format(rng.randint(1, 9), rng.randint(1, 9)),
+                        ),
+                    )
+                )
+            objects["chapter"].append((chapterSlots, dict(chapter=chapter)))
+            bookSlots.extend(chapterSlots)
+        objects["book"].append((bookSlots, dict(book=book)))
+
+    # assign node numbers
+
+    otypeRanges = [("word", 1, nWords)]
+    oslots = {}
+    n = nWords
+    for (otype, items) in objects.items():
+        first = n + 1
+        number = 0
+        for (slots, info) in items:
+            n += 1
+            number += 1
+            oslots[n] = _spec(slots)
+            if otype in {
+                "sentence",
+                "sentence_atom",
+                "clause",
+                "clause_atom",
+                "phrase",
+                "phrase_atom",
+            }:
+                feat("number", n, number)
+            for (name, value) in info.items():
+                feat(name, n, value)
+        otypeRanges.append((otype, first, n))
+    lexFirst = n + 1
+    lexSlots = {}
+    for (s, li) in enumerate(words, start=1):
+        lexSlots.setdefault(li, []).append(s)
+    for li in sorted(lexSlots):
+        n += 1
+        oslots[n] = _spec(lexSlots[li])
+        lx = lexemes[li]
+        feat("lex", n, lx["lex"])
+        feat("voc_lex", n, lx["voc"])
+        feat("voc_lex_utf8", n, lx["vocHeb"])
+        feat("gloss", n, lx["gloss"])
+        feat("root", n, lx["root"])
+        feat("sp", n, lx["sp"])
+        if lx["nametype"] is not None:
+            feat("nametype", n, lx["nametype"])
+        if lx["ls"] is not None:
+            feat("ls", n, lx["ls"])
+    otypeRanges.append(("lex", lexFirst, n))
+
+    # word features
+
+    freqs = {}
+    for li in words:
+        freqs[li] = freqs.get(li, 0) + 1
+    rank = {li: r + 1 for (r, li) in enumerate(sorted(freqs, key=lambda x: -freqs[x]))}
+    verseEnds = {slots[-1] for (slots, info) in objects["verse"]}
+
+    for (w, li) in enumerate(words, start=1):
+        lx = lexemes[li]
+        occ = lx["cons"] + (rng.choice(consonants) if rng.random() < 0.3 else "")
+        voc = "".join(c + rng.choice(vowels) for c in occ)
+        if w in verseEnds:
+            trailer = "׃ ס" if rng.random() < 0.1 else "׃ "
+        else:
+            trailer = "־" if rng.random() < 0.15 else " "
+        feat("g_cons", w, occ)
+        feat("g_cons_utf8", w, "".join(hebrew[c] for c in occ))
+        feat("g_word", w, voc)
+        feat("g_word_utf8", w, "".join(hebrew[c] + "\u05b7" for c in occ))
+        feat("trailer_utf8", w, trailer)
+        if rng.random() < 0.01:
+            feat("qere_utf8", w, "".join(hebrew[c] + "\u05b4" for c in occ))
+            feat("qere_trailer_utf8", w, trailer)
+        feat("languageISO", w, lx["lan"])
+        feat("lex", w, lx["lex"])
+        feat("g_lex", w, lx["voc"])
+        feat("lex_utf8", w, lx["heb"] + lx["lex"][len(lx["cons"]) :])
+        feat("sp", w, lx["sp"])
+        feat("pdp", w, lx["sp"])
+        feat("ls", w, lx["ls"] or "none")
+        verbal = lx["sp"] == "verb"
+        feat("vt", w, rng.choice(("perf", "impf", "wayq", "infc")) if verbal else "NA")
+        feat("vs", w, rng.choice(("qal", "piel", "hif", "nif")) if verbal else "NA")
+        feat("gn", w, rng.choice(("m", "f", "unknown", "NA")))
+        feat("nu", w, rng.choice(("sg", "pl", "du", "unknown", "NA")))
+        feat("ps", w, rng.choice(("p1", "p2", "p3", "unknown", "NA")))
+        feat("st", w, rng.choice(("a", "c", "e", "NA")))
+        for name in ("nme", "pfm", "prs", "uvf", "vbe", "vbs"):
+            feat(name, w, rng.choice(("absent", "n/a", "", "W", "H")))
+        feat("freq_lex", w, freqs[li])
+        feat("freq_occ", w, freqs[li])
+        feat("rank_lex", w, rank[li])
+        feat("rank_occ", w, rank[li])
+        feat("phono", w, voc.lower())
+        feat("phono_trailer", w, " " if trailer.endswith(" ") else "")
+
+    # write the features, the phonetic ones go to the phono repo
+
+    intFeatures = {
+        "number",
+        "chapter",
+        "verse",
+        "code",
+        "tab",
+        "freq_lex",
+        "freq_occ",
+        "rank_lex",
+        "rank_occ",
+    }
+    phonoFeatures = {"phono", "phono_trailer"}
+    tfDirs = {}
+    for repo in ("bhsa", "phono"):
+        tfDir = "{}/{}/tf/{}".format(base, repo, version)
+        if os.path.exists(tfDir):
+            rmtree(tfDir)
+        os.makedirs(tfDir)
+        tfDirs[repo] = tfDir
+
+    bhsaDir = tfDirs["bhsa"]
+    with open("{}/otype.tf".format(bhsaDir), "w") as fh:
+        fh.write(
+            "@node\n@description=node type\n@valueType=str\n"
+            "@version={}\n@writtenBy=benchmark.py\n\n".format(version)
+        )
+        for (otype, first, last) in otypeRanges:
+            fh.write("{}-{}\t{}\n".format(first, last, otype))
+    writeFeature(bhsaDir, "oslots", version, oslots, edge=True)
+    with open("{}/otext.tf".format(bhsaDir), "w") as fh:
+        fh.write(
+            "@config\n"
+            "@fmt:text-orig-full={g_word_utf8}{trailer_utf8}\n"
+            "@fmt:text-trans-full={g_word}{trailer_utf8}\n"
+            "@sectionFeatures=book,chapter,verse\n"
+            "@sectionTypes=book,chapter,verse\n"
+            "@version=" + version + "\n"
+            "@writtenBy=benchmark.py\n"
+        )
+    for (name, data) in sorted(features.items()):
+        writeFeature(
+            tfDirs["phono" if name in phonoFeatures else "bhsa"],
+            name,
+            version,
+            data,
+            valueType="int" if name in intFeatures else "str",
+        )
+    return (nWords, n)
+
+
+def setupBase(base, scale):
+    # a scratch ~/github/etcbc with the pipeline programs and a synthetic corpus
+    programs = "{}/{}/{}".format(base, pipeline.pipelineRepo, pipeline.programDir)
+    os.makedirs(programs, exist_ok=True)
+    here = os.path.dirname(os.path.abspath(__file__))
+    scratch = "{}/_scratch".format(base)
+    if os.path.exists(scratch):
+        rmtree(scratch)
+    for name in ("utils.py", "passageFromTf.ipynb"):
+        copy("{}/{}".format(here, name), programs)
+    return makeCorpus(base, benchVersion, scale=scale)
+
+
+def tfDir(base, repo, version):
+    return "{}/{}/tf/{}".format(base, repo, version)
+
+
+def benchPassage(base, passageFormat="sql", workers=1):
+    good = pipeline.runNb(
+        pipeline.pipelineRepo,
+        pipeline.programDir,
+        "passageFromTf",
+        force=True,
+        VERSION=benchVersion,
+        REPO_BASE=base,
+        PASSAGE_FORMAT=passageFormat,
+        WORKERS=workers,
+    )
+    if not good:
+        raise Exception("passageFromTf failed")
+
+
+def benchPassageBulk(base):
+    benchPassage(base, passageFormat="tsv")
+
+
+def benchPassageParallel(base):
+    benchPassage(base, workers=max(2, os.cpu_count()))
+
+
+def benchPassageSqlite(base):
+    benchPassage(base, passageFormat="sqlite")
+
+
+# typical lookups of SHEBANQ in the passage database:
+# name, query, query for the parameters to try it with
+
+passageQueries = (
+    (
+        "verse",
+        "select verse.id, verse.text, verse.xml from verse"
+        " join chapter on verse.chapter_id = chapter.id"
+        " join book on chapter.book_id = book.id"
+        " where book.name = ? and chapter.chapter_num = ? and verse.verse_num = ?",
+        "select book.name, chapter.chapter_num, verse.verse_num from verse"
+        " join chapter on verse.chapter_id = chapter.id"
+        " join book on chapter.book_id = book.id",
+    ),
+    (
+        "wordsOfVerse",
+        "select word.* from word_verse"
+        " join word on word.word_number = word_verse.anchor"
+        " where word_verse.verse_id = ? order by word_verse.anchor",
+        "select id from verse",
+    ),
+    (
+        "lexiconOfVerse",
+        "select word_verse.anchor, lexicon.* from word_verse"
+        " join lexicon on lexicon.id = word_verse.lexicon_id"
+        " where word_verse.verse_id = ? order by word_verse.anchor",
+        "select id from verse",
+    ),
+    (
+        "versesOfLexeme",
+        "select distinct book.name, chapter.chapter_num, verse.verse_num from word_verse"
+        " join verse on verse.id = word_verse.verse_id"
+        " join chapter on verse.chapter_id = chapter.id"
+        " join book on chapter.book_id = book.id"
+        " where word_verse.lexicon_id = ? order by verse.id",
+        "select id from lexicon",
+    ),
+)
+
+
+def benchPassageQueries(base, samples=500, seed=1):
+    # the SQLite passage database is made first, that is not part of the timing
+    benchPassageSqlite(base)
+    db = sqlite3.connect(
+        "{0}/bhsa/_temp/{1}/shebanq/shebanq_passage{1}.sqlite".format(
+            base, benchVersion
+        )
+    )
+    rng = random.Random(seed)
+    total = 0
+    for (name, query, paramQuery) in passageQueries:
+        params = db.execute(paramQuery).fetchall()
+        params = [rng.choice(params) for i in range(samples)]
+        start = time.perf_counter()
+        for p in params:
+            db.execute(query, p).fetchall()
+        elapsed = time.perf_counter() - start
+        total += elapsed
+        caption(
+            0,
+            "\t\t{:<16} {:>8.3f}ms per query".format(name, 1000 * elapsed / samples),
+        )
+    db.close()
+    return total
+
+
+def benchUpdateFeatures(base):
+    scratch = "{}/_scratch/tf".format(base)
+    if os.path.exists(scratch):
+        rmtree(scratch)
+    copytree(tfDir(base, "bhsa", benchVersion), scratch)
+    start = time.perf_counter()
+    pipeline.updateFeatures(scratch, benchVersionNew)
+    return time.perf_counter() - start
+
+
+def benchCopyVersion(base):
+    pipeline.copyVersion(
+        dict(repoOrder="bhsa phono", repoDataDirs=dict(bhsa="tf", phono="tf")),
+        benchVersion,
+        benchVersionNew,
+    )
+
+
+def benchCheckDiffs(base, semantic=False):
+    # compare with a copy in which a few features have changed
+    other = "{}/_scratch/diff".format(base)
+    if not os.path.exists(other):
+        copytree(tfDir(base, "bhsa", benchVersion), other)
+        for name in ("gloss", "typ"):
+            path = "{}/{}.tf".format(other, name)
+            with open(path) as fh:
+                lines = fh.readlines()
+            # change every 50th data line, the header ends with a blank line
+            start = lines.index("\n") + 1
+            with open(path, "w") as fh:
+                for (i, line) in enumerate(lines):
+                    fh.write(
+                        line.upper() if i >= start and (i - start) % 50 == 0 else line
+                    )
+    utils.checkDiffs(tfDir(base, "bhsa", benchVersion), other, semantic=semantic)
+
+
+def benchCheckDiffsSemantic(base):
+    benchCheckDiffs(base, semantic=True)
+
+
+def checkEdgeValues(base):
+    # a small edge feature with values, with implicit and with explicit nodes,
+    # must be read as node => {target: value} by the node by node comparison
+    scratch = "{}/_scratch/edges".format(base)
+    os.makedirs(scratch, exist_ok=True)
+    header = "@edge\n@edgeValues\n@valueType=str\n@writtenBy=benchmark.py\n\n"
+    expected = {1: {5: "a", 6: "a"}, 2: {7: "b"}, 3: {5: "c"}, 4: {8: "", 9: ""}}
+    forms = dict(
+        implicit="5-6\ta\n7\tb\n5\tc\n8-9\t\n",
+        explicit="1\t5\ta\n1\t6\ta\n2\t7\tb\n3\t5\tc\n4\t8-9\t\n",
+    )
+    for (form, text) in forms.items():
+        path = "{}/{}.tf".format(scratch, form)
+        with open(path, "w") as fh:
+            fh.write(header + text)
+        (isEdge, data) = utils._featureData(path)
+        if not isEdge or data != expected:
+            raise Exception("edge values read wrongly ({}): {}".format(form, data))
+
+
+def compressFile(base):
+    # a file of a realistic size: the text of all features, repeated
+    path = "{}/_scratch/data.txt".format(base)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        source = tfDir(base, "bhsa", benchVersion)
+        with open(path, "w") as fh:
+            for name in sorted(os.listdir(source)):
+                if name.startswith("."):
+                    continue
+                with open("{}/{}".format(source, name)) as sh:
+                    fh.write(sh.read())
+    return path
+
+
+def timeCompression(function, source, dest, **kwargs):
+    # the compression functions skip work if the destination is newer
+    if os.path.exists(dest):
+        os.unlink(dest)
+    start = time.perf_counter()
+    function(source, dest, **kwargs)
+    return time.perf_counter() - start
+
+
+def benchBzip(base):
+    path = compressFile(base)
+    return timeCompression(utils.bzip, path, path + ".bz2")
+
+
+def benchBzipParallel(base):
+    path = compressFile(base)
+    return timeCompression(utils.bzip, path, path + ".bz2", workers=os.cpu_count())
+
+
+def benchBunzip(base):
+    path = compressFile(base)
+    if not os.path.exists(path + ".bz2"):
+        utils.bzip(path, path + ".bz2")
+    return timeCompression(utils.bunzip, path + ".bz2", path + ".out")
+
+
+def benchGzip(base):
+    path = compressFile(base)
+    return timeCompression(utils.gzip, path, path + ".gz")
+
+
+def benchGunzip(base):
+    path = compressFile(base)
+    if not os.path.exists(path + ".gz"):
+        utils.gzip(path, path + ".gz")
+    return timeCompression(utils.gunzip, path + ".gz", path + ".out")
+
+
+# name, function, whether it needs Text-Fabric
+# a function may return its own timing, to leave out its preparation
+
+benchmarks = (
+    ("passageFromTf", benchPassage, True),
+    ("passageFromTfParallel", benchPassageParallel, True),
+    ("passageFromTfBulk", benchPassageBulk, True),
+    ("passageFromTfSqlite", benchPassageSqlite, True),
+    ("passageQueries", benchPassageQueries, True),
+    ("updateFeatures", benchUpdateFeatures, False),
+    ("copyVersion", benchCopyVersion, False),
+    ("checkDiffs", benchCheckDiffs, False),
+    ("checkDiffsSemantic", benchCheckDiffsSemantic, False),
+    ("bzip", benchBzip, False),
+    ("bzipParallel", benchBzipParallel, False),
+    ("bunzip", benchBunzip, False),
+    ("gzip", benchGzip, False),
+    ("gunzip", benchGunzip, False),
+)
+
+
+def hasTf():
+    return all(find_spec(module) is not None for module in ("tf", "nbconvert"))
+
+
+def runBenchmarks(scale=4, repeat=3, only=None, verbose=False, base=None):
+    outDir = repoBenchDir()
+    if base is None:
+        base = "{}/corpus-{}".format(outDir, scale)
+    caption(4, "Benchmark on a synthetic corpus of {} books in {}".format(scale, base))
+    (nWords, nNodes) = setupBase(base, scale)
+    caption(0, "\t{} words, {} nodes".format(nWords, nNodes))
+    checkEdgeValues(base)
+
+    savedBase = pipeline.githubBase
+    pipeline.githubBase = base
+    withTf = hasTf()
+    results = {}
+    try:
+        for (name, function, needsTf) in benchmarks:
+            if only is not None and name not in only:
+                continue
+            if needsTf and not withTf:
+                caption(0, "\t{:<20} skipped: Text-Fabric not installed".format(name))
+                continue
+            times = []
+            for i in range(repeat):
+                start = time.perf_counter()
+                if verbose:
+                    own = function(base)
+                else:
+                    with open(os.devnull, "w") as devnull:
+                        with redirect_stdout(devnull):
+                            own = function(base)
+                times.append(time.perf_counter() - start if own is None else own)
+            results[name] = dict(
+                best=round(min(times), 4), times=[round(t, 4) for t in times]
+            )
+            caption(0, "\t{:<20} {:>8.3f}s".format(name, min(times)))
+    finally:
+        pipeline.githubBase = savedBase
+
+    record = dict(
+        date=datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+        python=sys.version.split()[0],
+        scale=scale,
+        words=nWords,
+        nodes=nNodes,
+        repeat=repeat,
+        results=results,
+    )
+    previous = lastResults(outDir, scale)
+    resultFile = "{}/bench-{}.json".format(
+        outDir, datetime.now().strftime("%Y%m%d-%H%M%S")
+    )
+    os.makedirs(outDir, exist_ok=True)
+    with open(resultFile, "w") as fh:
+        json.dump(record, fh, indent=1, sort_keys=True)
+    caption(0, "Results saved in {}".format(resultFile))
+    if previous is not None:
+        compareResults(previous, record)
+    return record
+
+
+def lastResults(outDir, scale):
+    if not os.path.exists(outDir):
+        return None
+    for name in sorted(os.listdir(outDir), reverse=True):
+        if not (name.startswith("bench-") and name.endswith(".json")):
+            continue
+        with open("{}/{}".format(outDir, name)) as fh:
+            record = json.load(fh)
+        if record.get("scale", None) == scale:
+            return record
+    return None
+
+
+def compareResults(old, new, threshold=0.1, minSeconds=0.05):
+    caption(4, "Compared with the run of {}".format(old["date"]))
+    worse = []
+    for (name, result) in sorted(new["results"].items()):
+        if name not in old["results"]:
+            continue
+        (a, b) = (old["results"][name]["best"], result["best"])
+        change = (b - a) / a if a else 0
+        slower = change > threshold and b - a >= minSeconds
+        if slower:
+            worse.append(name)
+        caption(
+            0,
+            "\t{} {:<20} {:>8.3f}s => {:>8.3f}s ({:+.0%})".format(
+                "WORSE" if slower else "OK   ", name, a, b, change
+            ),
+            good=False if slower else None,
+        )
+    return worse
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    options = dict(scale=4, repeat=3, only=None, verbose=False)
+    while args:
+        arg = args.pop(0)
+        if arg == "--verbose":
+            options["verbose"] = True
+        elif arg in {"--scale", "--repeat"} and args:
+            options[arg[2:]] = int(args.pop(0))
+        elif arg == "--only" and args:
+            options["only"] = set(args.pop(0).split(","))
+        else:
+            caption(
+                0,
+                "usage: python benchmark.py [--scale books] [--repeat n] "
+                "[--only name,name] [--verbose]",
+            )
+            sys.exit(2)
+    runBenchmarks(**options)
@@ -0,0 +1,263 @@
+import os
+import sys
+import json
+import hashlib
+import marshal
+from shutil import copyfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from utils import caption
+
+# Content hashes of files are remembered together with their size and modification time,
+# so that a file is only read again when it has been touched.
+
+hashIndexFile = "hashes.json"
+blobDir = "blobs"
+entryDir = "entries"
+scriptDir = "scripts"
+chunkSize = 1024 * 1024
+
+hashIndex = None
+scriptCodes = {}
+nbConverter = None
+
+
+def _hashIndexPath(cacheDir):
+    return "{}/{}".format(cacheDir, hashIndexFile)
+
+
+def _readHashIndex(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except ValueError:
+        caption(0, "\tWARNING: hash index {} is corrupt, starting afresh".format(path))
+        return {}
+
+
+def loadHashIndex(cacheDir):
+    global hashIndex
+    if hashIndex is not None:
+        return
+    hashIndex = _readHashIndex(_hashIndexPath(cacheDir))
+
+
+def saveHashIndex(cacheDir):
+    # Worker processes of runGraph each have their own copy of the index,
+    # so the copy on disk is merged in under a lock before it is replaced:
+    # otherwise the workers would throw away each other's hashes.
+    # For a path known on both sides the entry of the latest modification time wins.
+    if hashIndex is None:
+        return
+    os.makedirs(cacheDir, exist_ok=True)
+    path = _hashIndexPath(cacheDir)
+    with open("{}.lock".format(path), "a") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        for (p, known) in _readHashIndex(path).items():
+            mine = hashIndex.get(p, None)
+            if mine is None or known[1] > mine[1]:
+                hashIndex[p] = known
+        tempPath = "{}.{}".format(path, os.getpid())
+        with open(tempPath, "w") as fh:
+            json.dump(hashIndex, fh)
+        os.replace(tempPath, path)
+
+
+def fileHash(path):
+    st = os.stat(path)
+    if hashIndex is not None:
+        known = hashIndex.get(path, None)
+        if known is not None and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+            return known[2]
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        while True:
+            chunk = fh.read(chunkSize)
+            if not chunk:
+                break
+            h.update(chunk)
+    digest = h.hexdigest()
+    if hashIndex is not None:
+        hashIndex[path] = [st.st_size, st.st_mtime_ns, digest]
+    return digest
+
+
+def paramHash(paramValues):
+    def canonical(x):
+        if isinstance(x, (set, frozenset)):
+            return sorted(x)
+        return repr(x)
+
+    return hashlib.sha256(
+        json.dumps(paramValues, sort_keys=True, default=canonical).encode("utf8")
+    ).hexdigest()
+
+
+def dataFiles(base, dirs):
+    # all visible files in the given directories, relative to base
+    # hidden files and directories (such as the compiled .tf cache) are skipped
+    files = {}
+    for d in dirs:
+        top = "{}/{}".format(base, d)
+        if not os.path.isdir(top):
+            continue
+        for (root, subDirs, names) in os.walk(top):
+            subDirs[:] = sorted(s for s in subDirs if not s.startswith("."))
+            for name in names:
+                if name.startswith("."):
+                    continue
+                path = "{}/{}".format(root, name)
+                files[os.path.relpath(path, base)] = path
+    return files
+
+
+def snapshot(files):
+    result = {}
+    for (rel, path) in files.items():
+        st = os.stat(path)
+        result[rel] = (st.st_size, st.st_mtime_ns)
+    return result
+
+
+def taskKey(nbFile, paramValues, inputs):
+    h = hashlib.sha256()
+    h.update(fileHash(nbFile).encode("utf8"))
+    h.update(paramHash(paramValues).encode("utf8"))
+    for (rel, path) in sorted(inputs.items()):
+        h.update("{}\t{}\n".format(rel, fileHash(path)).encode("utf8"))
+    return h.hexdigest()
+
+
+def _entryPath(cacheDir, version, repo, task):
+    return "{}/{}/{}/{}-{}.json".format(cacheDir, entryDir, version, repo, task)
+
+
+def readEntry(cacheDir, version, repo, task):
+    path = _entryPath(cacheDir, version, repo, task)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except ValueError:
+        return None
+
+
+def writeEntry(cacheDir, version, repo, task, entry):
+    path = _entryPath(cacheDir, version, repo, task)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tempPath = "{}.{}".format(path, os.getpid())
+    with open(tempPath, "w") as fh:
+        json.dump(entry, fh, indent=1, sort_keys=True)
+    os.replace(tempPath, path)
+
+
+def _blobPath(cacheDir, digest):
+    return "{}/{}/{}/{}".format(cacheDir, blobDir, digest[0:2], digest)
+
+
+def storeOutputs(cacheDir, base, outputs):
+    for (rel, digest) in outputs.items():
+        blob = _blobPath(cacheDir, digest)
+        if os.path.exists(blob):
+            continue
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        tempBlob = "{}.{}".format(blob, os.getpid())
+        copyfile("{}/{}".format(base, rel), tempBlob)
+        os.replace(tempBlob, blob)
+
+
+def restoreOutputs(cacheDir, base, outputs):
+    good = True
+    for (rel, digest) in sorted(outputs.items()):
+        path = "{}/{}".format(base, rel)
+        if os.path.exists(path) and fileHash(path) == digest:
+            continue
+        blob = _blobPath(cacheDir, digest)
+        if not os.path.exists(blob):
+            caption(0, "\tERROR: cached output {} is missing".format(rel))
+            good = False
+            continue
+        caption(0, "\trestoring {}".format(rel))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tempPath = "{}.{}".format(path, os.getpid())
+        copyfile(blob, tempPath)
+        os.replace(tempPath, path)
+    return good
+
+
+def _writeAtomic(path, data):
+    # other processes may be writing the same file at the same time
+    tempPath = "{}.{}".format(path, os.getpid())
+    with open(tempPath, "wb") as fh:
+        fh.write(data)
+    os.replace(tempPath, path)
+
+
+def _syncScript(srcFile, pyFile):
+    # tracebacks refer to pyFile, so it must hold the script that runs,
+    # also when the code comes from the cache and pyFile from another revision
+    with open(srcFile, "rb") as fh:
+        pyData = fh.read()
+    if os.path.exists(pyFile):
+        with open(pyFile, "rb") as fh:
+            if fh.read() == pyData:
+                return
+    _writeAtomic(pyFile, pyData)
+
+
+def scriptCode(nbFile, pyFile, cacheDir):
+    # The Python conversion of a notebook and its compiled code are kept on disk,
+    # keyed by the contents of the notebook.
+    # Only when the notebook has not been seen before, nbconvert is imported and called.
+    global nbConverter
+
+    with open(nbFile, "rb") as fh:
+        nbData = fh.read()
+    key = hashlib.sha256(nbData + pyFile.encode("utf8")).hexdigest()
+
+    scriptBase = "{}/{}/{}".format(cacheDir, scriptDir, key)
+    srcFile = "{}.py".format(scriptBase)
+    codeFile = "{}.{}.code".format(scriptBase, sys.implementation.cache_tag)
+
+    code = scriptCodes.get(key, None)
+    if code is not None:
+        _syncScript(srcFile, pyFile)
+        return code
+
+    if os.path.exists(codeFile) and os.path.exists(srcFile):
+        with open(codeFile, "rb") as fh:
+            try:
+                code = marshal.load(fh)
+            except (EOFError, ValueError, TypeError):
+                code = None
+
+    if code is None:
+        if os.path.exists(srcFile):
+            with open(srcFile) as fh:
+                pyScript = fh.read()
+        else:
+            caption(0, "\tconverting notebook to Python")
+            if nbConverter is None:
+                import nbformat
+                from nbconvert import PythonExporter
+
+                nbConverter = (nbformat, PythonExporter())
+            (nbformat, exporter) = nbConverter
+            nbObj = nbformat.reads(nbData.decode("utf8"), 4)
+            pyScript = exporter.from_notebook_node(nbObj)[0]
+            os.makedirs(os.path.dirname(srcFile), exist_ok=True)
+            _writeAtomic(srcFile, pyScript.encode("utf8"))
+        code = compile(pyScript, pyFile, "exec")
+        _writeAtomic(codeFile, marshal.dumps(code))
+    _syncScript(srcFile, pyFile)
+
+    scriptCodes[key] = code
+    return code
@@ -1,23 +1,39 @@
 import os
-from subprocess import Popen, PIPE
-from shutil import copy, copytree, rmtree
-import nbformat
-from nbconvert import PythonExporter
-from tf.fabric import Fabric
-
-from utils import bzip, caption
-
-py = PythonExporter()
+import bz2
+import gzip
+import threading
+from subprocess import Popen, PIPE, STDOUT
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+    FIRST_COMPLETED,
+)
+from shutil import copy, copyfileobj
+
+import utils
+from utils import bunzip, caption
+import buildcache
+import runjournal
+import telemetry
+import transfer
 
 githubBase = os.path.expanduser("~/github/etcbc")
 pipelineRepo = "pipeline"
 utilsScript = "programs/utils.py"
 
 programDir = "programs"
+cacheDir = "_temp/cache"
+historyFile = "_temp/history/runs.jsonl"
+journalDir = "_temp/journal"
 standardParams = "CORE_NAME VERSION".strip().split()
+mysqlCommand = "mysql -u root"
+mqlCommand = "mql -n -b m -u root -e UTF8"
+importConcurrency = 2
+passageWorkers = 1
 
 
-def runNb(repo, dirName, nb, force=False, **parameters):
+def runNb(repo, dirName, nb, force=False, shareTf=False, **parameters):
     caption(3, "Run notebook [{}/{}] with parameters:".format(repo, nb))
     for (param, value) in sorted(parameters.items()):
         caption(0, "\t{:<20} = {}".format(param, value))
@@ -25,29 +41,181 @@ def runNb(repo, dirName, nb, force=False, **parameters):
     location = "{}/{}/{}".format(githubBase, repo, dirName)
     nbFile = "{}/{}.ipynb".format(location, nb)
     pyFile = "{}/{}.py".format(location, nb)
-    nbObj = nbformat.read(nbFile, 4)
-    pyScript = py.from_notebook_node(nbObj)[0]
-    with open(pyFile, "w") as s:
-        s.write(pyScript)
+    code = buildcache.scriptCode(nbFile, pyFile, cacheLocation())
     os.chdir(location)
+    utils.shareTf = shareTf
     good = True
-    with open(pyFile) as s:
-        locals()["SCRIPT"] = True
-        locals()["FORCE"] = force
-        locals()["NAME"] = repo
-        for (param, value) in parameters.items():
-            locals()[param] = value
-
-        try:
-            exec(s.read(), locals())
-        except SystemExit as inst:
-            good = inst.args[0] == 0
-        caption(0, "{} {}".format("SUCCESS" if good else "FAILURE", nb))
+    # each run gets a fresh namespace, with the parameters as global variables
+    namespace = dict(SCRIPT=True, FORCE=force, NAME=repo)
+    for (param, value) in parameters.items():
+        namespace[param] = value
+
+    measurement = telemetry.startMeasure()
+    try:
+        exec(code, namespace)
+    except SystemExit as inst:
+        good = inst.args[0] == 0
+    caption(0, "{} {}".format("SUCCESS" if good else "FAILURE", nb))
+    telemetry.endMeasure(
+        measurement,
+        historyLocation(),
+        kind="task",
+        version=parameters.get("VERSION", None),
+        repo=repo,
+        task=nb,
+        good=good,
+    )
 
     caption(3, "[{}/{}]".format(repo, nb), good=good)
+    # worker processes do not run exit handlers, so write out the log now
+    utils.flush()
+    return good
+
+
+def cacheLocation():
+    return "{}/{}/{}".format(githubBase, pipelineRepo, cacheDir)
+
+
+def historyLocation():
+    return "{}/{}/{}".format(githubBase, pipelineRepo, historyFile)
+
+
+def journalLocation():
+    return "{}/{}/{}".format(githubBase, pipelineRepo, journalDir)
+
+
+def repoDirs(dataDirs, repo, version):
+    return [
+        "{}/{}/{}".format(repo, dataDir, version)
+        for dataDir in (dataDirs or {}).get(repo, "tf").strip().split()
+    ]
+
+
+def upstreamTasks(graph, node):
+    seen = set()
+    stack = [node]
+    while stack:
+        for prereq in graph.get(stack.pop(), ()):
+            if prereq not in seen:
+                seen.add(prereq)
+                stack.append(prereq)
+    return seen
+
+
+def taskInputs(node, graph, dataDirs, version):
+    # the data of the repo of the task itself, plus the tf data of the repos it depends on,
+    # minus the recorded outputs of the tasks that do not come before it
+    (repo, task) = node
+    upstream = upstreamTasks(graph, node)
+    inputs = buildcache.dataFiles(githubBase, repoDirs(dataDirs, repo, version))
+    for upRepo in sorted({r for (r, t) in upstream} - {repo}):
+        inputs.update(
+            buildcache.dataFiles(githubBase, ["{}/tf/{}".format(upRepo, version)])
+        )
+    for other in graph:
+        if other in upstream:
+            continue
+        entry = buildcache.readEntry(cacheLocation(), version, *other)
+        if entry is not None:
+            for rel in entry["outputs"]:
+                inputs.pop(rel, None)
+    return inputs
+
+
+def runTask(
+    repo,
+    task,
+    force=False,
+    cache=False,
+    shareTf=False,
+    graph=None,
+    dataDirs=None,
+    **paramValues,
+):
+    location = cacheLocation()
+    buildcache.loadHashIndex(location)
+    version = paramValues.get("VERSION", "UNKNOWN")
+    node = (repo, task)
+    if graph is None:
+        graph = {node: set()}
+    nbFile = "{}/{}/{}/{}.ipynb".format(githubBase, repo, programDir, task)
+
+    entry = None
+    if cache:
+        key = buildcache.taskKey(
+            nbFile, paramValues, taskInputs(node, graph, dataDirs, version)
+        )
+        entry = buildcache.readEntry(location, version, repo, task)
+        if not force and entry is not None and entry["key"] == key:
+            caption(3, "[{}/{}] unchanged, using cached results".format(repo, task))
+            good = buildcache.restoreOutputs(location, githubBase, entry["outputs"])
+            if good:
+                runjournal.recordTask(
+                    journalLocation(),
+                    version,
+                    repo,
+                    task,
+                    nbFile,
+                    paramValues,
+                    entry["outputs"],
+                )
+                buildcache.saveHashIndex(location)
+                return True
+            caption(0, "\tcache incomplete, running the task anyway")
+
+    outDirs = repoDirs(dataDirs, repo, version)
+    before = buildcache.snapshot(buildcache.dataFiles(githubBase, outDirs))
+    good = runNb(repo, programDir, task, force=force, shareTf=shareTf, **paramValues)
+    if good:
+        after = buildcache.dataFiles(githubBase, outDirs)
+        afterState = buildcache.snapshot(after)
+        outputs = {}
+        if entry is not None:
+            for rel in entry["outputs"]:
+                if rel in after:
+                    outputs[rel] = None
+        for rel in after:
+            if before.get(rel, None) != afterState[rel]:
+                outputs[rel] = None
+        for rel in outputs:
+            outputs[rel] = buildcache.fileHash(after[rel])
+
+        if cache:
+            buildcache.storeOutputs(location, githubBase, outputs)
+            inputs = taskInputs(node, graph, dataDirs, version)
+            for rel in outputs:
+                inputs.pop(rel, None)
+            key = buildcache.taskKey(nbFile, paramValues, inputs)
+            buildcache.writeEntry(
+                location, version, repo, task, dict(key=key, outputs=outputs)
+            )
+        runjournal.recordTask(
+            journalLocation(), version, repo, task, nbFile, paramValues, outputs
+        )
+    buildcache.saveHashIndex(location)
     return good
 
 
+def taskResumable(resumeState, graph, repo, task, paramValues):
+    # a task can be skipped when resuming if it has completed in an earlier run,
+    # and all tasks it depends on have been skipped as well
+    if resumeState is None:
+        return False
+    node = (repo, task)
+    if not graph.get(node, set()) <= resumeState["done"]:
+        return False
+    nbFile = "{}/{}/{}/{}.ipynb".format(githubBase, repo, programDir, task)
+    buildcache.loadHashIndex(cacheLocation())
+    done = runjournal.taskDone(
+        resumeState["records"], githubBase, repo, task, nbFile, paramValues
+    )
+    buildcache.saveHashIndex(cacheLocation())
+    if done:
+        caption(3, "[{}/{}] completed in an earlier run".format(repo, task))
+        resumeState["done"].add(node)
+    return done
+
+
 def checkRepo(repo, repoConfig, force=False, **parameters):
     good = True
     for item in repoConfig:
@@ -69,36 +237,260 @@ def checkRepo(repo, repoConfig, force=False, **parameters):
     return good
 
 
-def runRepo(repo, repoConfig, force=False, **parameters):
-    caption(2, "Make repo [{}]".format(repo))
+def copyUtils(repo):
     # copy the utils.py from the pipeline repo to the target repo
-    copy(
-        "{}/{}/{}".format(githubBase, pipelineRepo, utilsScript),
-        "{}/{}/{}".format(githubBase, repo, utilsScript),
-    )
+    target = "{}/{}/{}".format(githubBase, repo, utilsScript)
+    tempTarget = "{}.{}".format(target, os.getpid())
+    copy("{}/{}/{}".format(githubBase, pipelineRepo, utilsScript), tempTarget)
+    os.replace(tempTarget, target)
+
+
+def taskParams(item, parameters):
+    paramValues = dict()
+    for (param, values) in parameters.items():
+        paramValues[param] = parameters[param]
+
+    if "params" in item:
+        paramValues.update(item["params"])
+    return paramValues
+
+
+def runRepo(
+    repo,
+    repoConfig,
+    force=False,
+    cache=False,
+    shareTf=False,
+    graph=None,
+    dataDirs=None,
+    report=None,
+    resumeState=None,
+    **parameters,
+):
+    caption(2, "Make repo [{}]".format(repo))
+    measurement = telemetry.startMeasure()
+    copyUtils(repo)
+    if graph is None:
+        (good, graph) = taskGraph([repo], {repo: repoConfig})
     good = True
     for item in repoConfig:
         task = item["task"]
         omit = item.get("omit", set())
-        paramValues = dict()
-        for (param, values) in parameters.items():
-            paramValues[param] = parameters[param]
-
-        if "params" in item:
-            paramValues.update(item["params"])
+        paramValues = taskParams(item, parameters)
         version = paramValues.get("VERSION", "UNKNOWN")
         if version in omit:
             caption(3, "[{}/{}] skipped in version [{}]".format(repo, task, version))
+            addReport(report, version, repo, task, None)
+            if resumeState is not None:
+                resumeState["done"].add((repo, task))
+            continue
+        if taskResumable(resumeState, graph, repo, task, paramValues):
+            addReport(report, version, repo, task, True)
             continue
 
-        good = runNb(repo, programDir, task, force=force, **paramValues)
+        good = runTask(
+            repo,
+            task,
+            force=force,
+            cache=cache,
+            shareTf=shareTf,
+            graph=graph,
+            dataDirs=dataDirs,
+            **paramValues,
+        )
+        addReport(report, version, repo, task, good)
         if not good:
             break
+    telemetry.endMeasure(
+        measurement,
+        historyLocation(),
+        kind="repo",
+        version=parameters.get("VERSION", None),
+        repo=repo,
+        good=good,
+    )
     caption(2, "[{}]".format(repo), good=good)
     return good
 
 
-def runRepos(repoOrder, repoConfig, repos=None, force=False, **parameters):
+def taskGraph(repos, repoConfig):
+    # Every task depends on the tasks mentioned in its "depends" key:
+    # a repo name stands for all tasks of that repo, repo/task for a single task.
+    # Without a "depends" key, a task depends on the previous task of its repo,
+    # and the first task of a repo depends on all tasks of the preceding repos.
+    # Dependencies on repos that do not take part in this run count as fulfilled.
+    good = True
+    repoTasks = {}
+    for repo in repos:
+        repoTasks[repo] = [(repo, item["task"]) for item in repoConfig[repo]]
+
+    graph = {}
+    prevRepos = []
+    for repo in repos:
+        prevNode = None
+        for item in repoConfig[repo]:
+            node = (repo, item["task"])
+            depends = item.get("depends", None)
+            if depends is None:
+                if prevNode is None:
+                    prereqs = {n for r in prevRepos for n in repoTasks[r]}
+                else:
+                    prereqs = {prevNode}
+            else:
+                prereqs = set()
+                for dep in depends.strip().split():
+                    (dRepo, dTask) = dep.split("/", 1) if "/" in dep else (dep, None)
+                    if dRepo not in repoConfig:
+                        caption(
+                            0,
+                            "ERROR: {}/{} depends on unknown repo {}".format(
+                                repo, item["task"], dRepo
+                            ),
+                        )
+                        good = False
+                        continue
+                    if dRepo not in repoTasks:
+                        continue
+                    if dTask is None:
+                        prereqs |= set(repoTasks[dRepo])
+                    elif (dRepo, dTask) in repoTasks[dRepo]:
+                        prereqs.add((dRepo, dTask))
+                    else:
+                        caption(
+                            0,
+                            "ERROR: {}/{} depends on unknown task {}".format(
+                                repo, item["task"], dep
+                            ),
+                        )
+                        good = False
+                prereqs.discard(node)
+            graph[node] = prereqs
+            prevNode = node
+        prevRepos.append(repo)
+    return (good, graph)
+
+
+def runGraph(
+    repos,
+    repoConfig,
+    graph,
+    workers,
+    force=False,
+    cache=False,
+    shareTf=False,
+    dataDirs=None,
+    report=None,
+    resumeState=None,
+    **parameters,
+):
+    caption(2, "Make repos [{}] with {} workers".format(" ".join(repos), workers))
+    measurement = telemetry.startMeasure()
+    good = True
+    items = {}
+    order = []
+    for repo in repos:
+        copyUtils(repo)
+        for item in repoConfig[repo]:
+            node = (repo, item["task"])
+            items[node] = item
+            order.append(node)
+
+    pending = set(order)
+    done = set()
+    running = {}
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while True:
+            progress = good
+            while progress:
+                progress = False
+                for node in order:
+                    if node not in pending or not graph[node] <= done:
+                        continue
+                    pending.discard(node)
+                    (repo, task) = node
+                    item = items[node]
+                    paramValues = taskParams(item, parameters)
+                    version = paramValues.get("VERSION", "UNKNOWN")
+                    if version in item.get("omit", set()):
+                        caption(
+                            3,
+                            "[{}/{}] skipped in version [{}]".format(
+                                repo, task, version
+                            ),
+                        )
+                        addReport(report, version, repo, task, None)
+                        if resumeState is not None:
+                            resumeState["done"].add(node)
+                        done.add(node)
+                        progress = True
+                        continue
+                    if taskResumable(resumeState, graph, repo, task, paramValues):
+                        addReport(report, version, repo, task, True)
+                        done.add(node)
+                        progress = True
+                        continue
+                    future = pool.submit(
+                        runTask,
+                        repo,
+                        task,
+                        force=force,
+                        cache=cache,
+                        shareTf=shareTf,
+                        graph=graph,
+                        dataDirs=dataDirs,
+                        **paramValues,
+                    )
+                    running[future] = (repo, task, version)
+            if not running:
+                break
+            (finished, rest) = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                (repo, task, version) = running.pop(future)
+                try:
+                    thisGood = future.result()
+                except Exception as inst:
+                    caption(0, "ERROR: {}/{} raised {!r}".format(repo, task, inst))
+                    thisGood = False
+                addReport(report, version, repo, task, thisGood)
+                if thisGood:
+                    done.add((repo, task))
+                else:
+                    good = False
+
+    if good and pending:
+        caption(
+            0,
+            "ERROR: circular dependencies between {}".format(
+                " ".join("{}/{}".format(*node) for node in order if node in pending)
+            ),
+        )
+        good = False
+    telemetry.endMeasure(
+        measurement,
+        historyLocation(),
+        kind="repos",
+        version=parameters.get("VERSION", None),
+        repo=" ".join(repos),
+        good=good,
+    )
+    caption(2, "[{}]".format(" ".join(repos)), good=good)
+    return good
+
+
+def runRepos(
+    repoOrder,
+    repoConfig,
+    repos=None,
+    force=False,
+    workers=None,
+    cache=False,
+    shareTf=False,
+    dataDirs=None,
+    report=None,
+    resume=False,
+    **parameters,
+):
     good = True
     doRepos = []
     for repo in repoOrder.strip().split():
@@ -115,14 +507,67 @@ def runRepos(repoOrder, repoConfig, repos=None, force=False, **parameters):
     if not good:
         return False
 
+    (good, graph) = taskGraph(doRepos, repoConfig)
+    if not good:
+        return False
+
+    version = parameters.get("VERSION", "UNKNOWN")
+    if resume:
+        resumeState = dict(
+            records=runjournal.readJournal(journalLocation(), version), done=set()
+        )
+    else:
+        resumeState = None
+        runjournal.startJournal(journalLocation(), version, set(graph))
+
+    if workers is not None and workers > 1:
+        return runGraph(
+            doRepos,
+            repoConfig,
+            graph,
+            workers,
+            force=force,
+            cache=cache,
+            shareTf=shareTf,
+            dataDirs=dataDirs,
+            report=report,
+            resumeState=resumeState,
+            **parameters,
+        )
+
     for repo in doRepos:
-        good = runRepo(repo, repoConfig[repo], force=force, **parameters)
+        good = runRepo(
+            repo,
+            repoConfig[repo],
+            force=force,
+            cache=cache,
+            shareTf=shareTf,
+            graph=graph,
+            dataDirs=dataDirs,
+            report=report,
+            resumeState=resumeState,
+            **parameters,
+        )
         if not good:
             break
     return good
 
 
-def runVersion(pipeline, repos=None, version=None, force=False):
+def runVersion(
+    pipeline,
+    repos=None,
+    version=None,
+    force=False,
+    workers=None,
+    cache=True,
+    shareTf=False,
+    report=None,
+    resume=False,
+):
+    # With cache=True a task whose key has not changed is not run again (see runTask).
+    # The key only covers the notebook, its parameters, the data directories of its repo
+    # (repoDataDirs) and the tf data of the repos it depends on: a notebook that reads
+    # anything else gets the outputs of its previous run. Pass cache=False then.
     caption(1, "Make version [{}]".format(version))
 
     good = True
@@ -187,47 +632,214 @@ def runVersion(pipeline, repos=None, version=None, force=False):
     if not good:
         return False
 
-    good = runRepos(repoOrder, repoConfig, repos=repos, force=force, **paramValues)
+    measurement = telemetry.startMeasure()
+    good = runRepos(
+        repoOrder,
+        repoConfig,
+        repos=repos,
+        force=force,
+        workers=workers,
+        cache=cache,
+        shareTf=shareTf,
+        dataDirs=pipeline.get("repoDataDirs", None),
+        report=report,
+        resume=resume,
+        **paramValues,
+    )
+    telemetry.endMeasure(
+        measurement, historyLocation(), kind="version", version=version, good=good
+    )
     caption(1, "[{}]".format(version), good=good)
     return good
 
 
-def runPipeline(pipeline, repos=None, versions=None, force=False):
+def runVersionIsolated(
+    pipeline, repos, version, force, workers, cache, shareTf, resume
+):
+    # runs in a worker process of its own, with a working directory of its own
+    workDir = "{}/{}/_temp/versions/{}".format(githubBase, pipelineRepo, version)
+    os.makedirs(workDir, exist_ok=True)
+    os.chdir(workDir)
+    report = []
+    good = runVersion(
+        pipeline,
+        repos=repos,
+        version=version,
+        force=force,
+        workers=workers,
+        cache=cache,
+        shareTf=shareTf,
+        report=report,
+        resume=resume,
+    )
+    return (good, report)
+
+
+def runPipeline(
+    pipeline,
+    repos=None,
+    versions=None,
+    force=False,
+    workers=None,
+    cache=True,
+    shareTf=False,
+    parallel=None,
+    resume=False,
+):
+    # cache=True only notices changes in repoDataDirs and upstream tf data,
+    # see runVersion; pass cache=False for notebooks that read anything else
     good = True
     chosenVersions = (
         [] if versions is None else [versions] if type(versions) is str else versions
     )
-    for version in chosenVersions:
-        thisGood = runVersion(pipeline, repos=repos, version=version, force=force)
-        if not thisGood:
-            good = False
+    telemetry.newRun()
+    report = []
+    versionResults = []
+    if parallel is not None and parallel > 1 and len(chosenVersions) > 1:
+        caption(
+            1,
+            "Make versions [{}], {} at a time".format(
+                " ".join(chosenVersions), parallel
+            ),
+        )
+        with ProcessPoolExecutor(max_workers=parallel) as pool:
+            futures = [
+                (
+                    version,
+                    pool.submit(
+                        runVersionIsolated,
+                        pipeline,
+                        repos,
+                        version,
+                        force,
+                        workers,
+                        cache,
+                        shareTf,
+                        resume,
+                    ),
+                )
+                for version in chosenVersions
+            ]
+            for (version, future) in futures:
+                try:
+                    (thisGood, thisReport) = future.result()
+                except Exception as inst:
+                    caption(0, "ERROR: version {} raised {!r}".format(version, inst))
+                    (thisGood, thisReport) = (False, [])
+                report.extend(thisReport)
+                versionResults.append((version, thisGood))
+                if not thisGood:
+                    good = False
+    else:
+        for version in chosenVersions:
+            thisGood = runVersion(
+                pipeline,
+                repos=repos,
+                version=version,
+                force=force,
+                workers=workers,
+                cache=cache,
+                shareTf=shareTf,
+                report=report,
+                resume=resume,
+            )
+            versionResults.append((version, thisGood))
+            if not thisGood:
+                good = False
+    showReport(report, versionResults)
     return good
 
 
-def updateFeatures(toDir, toVersion):
+def addReport(report, version, repo, task, good):
+    if report is not None:
+        report.append(dict(version=version, repo=repo, task=task, good=good))
+
+
+def showReport(report, versionResults):
+    caption(1, "Summary")
+    for (version, good) in versionResults:
+        caption(0, "version {:<8} {}".format(version, "SUCCESS" if good else "FAILURE"))
+        for record in report:
+            if record["version"] != version:
+                continue
+            good = record["good"]
+            caption(
+                0,
+                "\t{:<12} {:<20} {}".format(
+                    record["repo"],
+                    record["task"],
+                    "skipped" if good is None else "SUCCESS" if good else "FAILURE",
+                ),
+            )
+
+
+def _copyRange(src, dst, offset):
+    # copy the rest of src from offset to dst, inside the kernel where possible
+    srcFd = src.fileno()
+    dstFd = dst.fileno()
+    size = os.fstat(srcFd).st_size
+    for copier in ("copy_file_range", "sendfile"):
+        if not hasattr(os, copier):
+            continue
+        try:
+            while offset < size:
+                if copier == "copy_file_range":
+                    n = os.copy_file_range(srcFd, dstFd, size - offset, offset)
+                else:
+                    n = os.sendfile(dstFd, srcFd, offset, size - offset)
+                if n == 0:
+                    break
+                offset += n
+            return
+        except OSError:
+            continue
+    src.seek(offset)
+    copyfileobj(src, dst)
+
+
+def updateFeature(featureFile, toVersion):
+    # only the metadata header is read and written,
+    # the data is copied as a whole behind it
+    versionLine = f"@version={toVersion}\n".encode("utf8")
+    header = []
+    changed = False
+    with open(featureFile, "rb") as fh:
+        while True:
+            offset = fh.tell()
+            line = fh.readline()
+            if not line.startswith(b"@"):
+                break
+            if line.startswith(b"@version=") and line != versionLine:
+                line = versionLine
+                changed = True
+            header.append(line)
+        if not changed:
+            return False
+        # write a new file and put it in place, never write into the old one:
+        # in the staging tree of deliverTree it may be a hard link to the live target
+        tempFile = f"{featureFile}.{os.getpid()}"
+        with open(tempFile, "wb") as out:
+            out.write(b"".join(header))
+            out.flush()
+            _copyRange(fh, out, offset)
+    os.replace(tempFile, featureFile)
+    return True
+
+
+def updateFeatures(toDir, toVersion, workers=None):
     # the metadata in the feature files in toDir will change:
     # @version=fromVersion ====> @version=toVersion
     with os.scandir(toDir) as tfIt:
-        for tfEntry in tfIt:
-            if not tfEntry.is_file():
-                continue
-            featureFile = f"{toDir}/{tfEntry.name}"
-            with open(featureFile) as fh:
-                inLines = fh.readlines()
-            with open(featureFile, "w") as fh:
-                inMeta = True
-                for line in inLines:
-                    if inMeta:
-                        if len(line) == 0 or line[0] != "@":
-                            inMeta = False
-                            fh.write(line)
-                            continue
-                        if line.startswith("@version="):
-                            fh.write(f"@version={toVersion}\n")
-                            continue
-                        fh.write(line)
-                        continue
-                    fh.write(line)
+        featureFiles = sorted(
+            f"{toDir}/{tfEntry.name}" for tfEntry in tfIt if tfEntry.is_file()
+        )
+    nWorkers = os.cpu_count() if workers is None else workers
+    if nWorkers > 1 and len(featureFiles) > 1:
+        with ProcessPoolExecutor(max_workers=min(nWorkers, len(featureFiles))) as pool:
+            list(pool.map(updateFeature, featureFiles, [toVersion] * len(featureFiles)))
+    else:
+        for featureFile in featureFiles:
+            updateFeature(featureFile, toVersion)
 
 
 def copyVersion(pipeline, fromVersion, toVersion):
@@ -256,8 +868,7 @@ def copyVersion(pipeline, fromVersion, toVersion):
                 ),
             )
             if os.path.exists(toDir):
-                caption(0, "\t\tremoving existing {}/{}".format(dataDir, toVersion))
-                rmtree(toDir)
+                caption(0, "\t\treplacing existing {}/{}".format(dataDir, toVersion))
             else:
                 caption(0, "\t\tno existing {}/{}".format(dataDir, toVersion))
             if os.path.exists(fromDir):
@@ -265,7 +876,6 @@ def copyVersion(pipeline, fromVersion, toVersion):
                     0,
                     "\t\tputting data in place from {}/{}".format(dataDir, fromVersion),
                 )
-                copytree(fromDir, toDir)
                 if dataDir == "tf":
                     caption(
                         0,
@@ -273,7 +883,17 @@ def copyVersion(pipeline, fromVersion, toVersion):
                             toVersion
                         ),
                     )
-                    updateFeatures(toDir, toVersion)
+                # the new version gets copies (reflinks where the file system can),
+                # since the pipeline will write into its files when it runs on it
+                utils.deliverTree(
+                    utils.treeFiles(fromDir),
+                    toDir,
+                    prepare=(
+                        (lambda stagingDir: updateFeatures(stagingDir, toVersion))
+                        if dataDir == "tf"
+                        else None
+                    ),
+                )
             else:
                 caption(0, "\t\tNo data found in {}/{}".format(dataDir, fromVersion))
         caption(2, "Repo {} done".format(repo))
@@ -298,19 +918,82 @@ def run(cmd):
     return p.returncode == 0
 
 
-def webPipeline(pipeline, versions=None, force=False, kinds={"mql", "mysql"}):
+def webPipeline(
+    pipeline,
+    versions=None,
+    force=False,
+    kinds={"mql", "mysql"},
+    shareTf=False,
+    workers=None,
+    mqlCopy=False,
+    passageFormat="sql",
+    passageWorkers=passageWorkers,
+):
     good = True
     chosenVersions = (
         [] if versions is None else [versions] if type(versions) is str else versions
     )
+    telemetry.newRun()
     for version in chosenVersions:
-        thisGood = webPipelineSingle(pipeline, version, force=force, kinds=kinds)
+        thisGood = webPipelineSingle(
+            pipeline,
+            version,
+            force=force,
+            kinds=kinds,
+            shareTf=shareTf,
+            workers=workers,
+            mqlCopy=mqlCopy,
+            passageFormat=passageFormat,
+            passageWorkers=passageWorkers,
+        )
         if not thisGood:
             good = False
     return good
 
 
-def webPipelineSingle(pipeline, version, force=False, kinds={"mql", "mysql"}):
+def exportFeatures(repoOrder, version):
+    # the content hashes of the feature files that go into the MQL export
+    dirs = ["{}/tf/{}".format(repo, version) for repo in repoOrder]
+    return {
+        rel: buildcache.fileHash(path)
+        for (rel, path) in sorted(buildcache.dataFiles(githubBase, dirs).items())
+        if rel.endswith(".tf")
+    }
+
+
+def mqlStaleness(manifest, features, mqlZFile, limit=5):
+    # the reasons why the MQL export has to be made again, if any
+    if not os.path.exists(mqlZFile):
+        return ["{} does not exist".format(mqlZFile)]
+    if manifest is None or "bz2" not in manifest:
+        return ["there is no manifest of the features in the previous export"]
+    if buildcache.fileHash(mqlZFile) != manifest["bz2"]:
+        return ["{} is not the previous export".format(mqlZFile)]
+    old = manifest["features"]
+    reasons = []
+    for rel in sorted(set(old) | set(features)):
+        if rel not in old:
+            reasons.append("feature {} is new".format(rel))
+        elif rel not in features:
+            reasons.append("feature {} has gone".format(rel))
+        elif old[rel] != features[rel]:
+            reasons.append("feature {} has changed".format(rel))
+    if len(reasons) > limit:
+        reasons = reasons[0:limit] + ["... and {} more".format(len(reasons) - limit)]
+    return reasons
+
+
+def webPipelineSingle(
+    pipeline,
+    version,
+    force=False,
+    kinds={"mql", "mysql"},
+    shareTf=False,
+    workers=None,
+    mqlCopy=False,
+    passageFormat="sql",
+    passageWorkers=passageWorkers,
+):
     good = True
 
     if "mql" in kinds:
@@ -340,37 +1023,16 @@ def webPipelineSingle(pipeline, version, force=False, kinds={"mql", "mysql"}):
         mqlUFile = "{}/{}.mql".format(tempShebanqDir, dbName)
         mqlZFile = "{}/{}.mql.bz2".format(shebanqDir, dbName)
 
-        xmU = os.path.exists(mqlUFile)
-        # xmZ = os.path.exists(mqlZFile)
-
-        uptodate = True
-
-        referenceFile = mqlUFile if xmU else mqlZFile
-
-        if not os.path.exists(referenceFile):
-            uptodate = False
-            caption(0, "\tWork to do because {} does not exist".format(referenceFile))
-        else:
-            tmR = os.path.getmtime(referenceFile)
-            for (i, repo) in enumerate(repoOrder):
-                tfxDir = "{}/{}/tf/{}/.tf".format(githubBase, repo, version)
-                if not os.path.exists(tfxDir):
-                    uptodate = False
-                    caption(
-                        0, "\tWork to do because the tf in {} is fresh".format(repo)
-                    )
-                    caption(0, "\t\t{}".format(tfxDir))
-                    break
-                if os.path.getmtime(tfxDir) > tmR:
-                    uptodate = False
-                    caption(
-                        0,
-                        "\tWork to do because the tf in {} is recently compiled".format(
-                            repo
-                        ),
-                    )
-                    caption(0, "\t\t{}".format(tfxDir))
-                    break
+        # The export is up to date if its manifest lists exactly the current
+        # contents of the feature files; touching or recompiling them does not count.
+        location = cacheLocation()
+        buildcache.loadHashIndex(location)
+        features = exportFeatures(repoOrder, version)
+        manifest = buildcache.readEntry(location, version, "shebanq", "mql")
+        reasons = mqlStaleness(manifest, features, mqlZFile)
+        uptodate = not reasons
+        for reason in reasons:
+            caption(0, "\tWork to do because {}".format(reason))
 
         if uptodate and force:
             caption(0, "\tWork to do because you forced me to!")
@@ -381,112 +1043,314 @@ def webPipelineSingle(pipeline, version, force=False, kinds={"mql", "mysql"}):
             for (i, repo) in enumerate(repoOrder):
                 locations.append("{}/{}/tf/{}".format(githubBase, repo, version))
 
-            TF = Fabric(locations=locations, modules=[""])
-            TF.exportMQL(dbName, exportDir=tempShebanqDir)
+            api = utils.loadTf(locations, [""], "", share=shareTf)
+            # the export goes straight into the compressor,
+            # and into an uncompressed copy for importing if asked for
+            caption(0, "\tbzipping the export into {} ...".format(mqlZFile))
+            if mqlCopy:
+                caption(0, "\tand copying it into {} ...".format(mqlUFile))
+                os.makedirs(tempShebanqDir, exist_ok=True)
+            elif os.path.exists(mqlUFile):
+                os.unlink(mqlUFile)
+            digest = utils.bzipFrom(
+                lambda exportDir: api.TF.exportMQL(dbName, exportDir=exportDir),
+                "{}.mql".format(dbName),
+                mqlZFile,
+                uzFile=mqlUFile if mqlCopy else None,
+                workers=workers,
+            )
+            if digest is None:
+                caption(1, "MQL export failed for {}".format(dbName), good=False)
+                return False
+            buildcache.writeEntry(
+                location,
+                version,
+                "shebanq",
+                "mql",
+                dict(features=features, mql=digest, bz2=buildcache.fileHash(mqlZFile)),
+            )
         else:
             caption(0, "\tAlready up to date")
-
-        caption(0, "\tbzipping {}".format(mqlUFile))
-        caption(0, "\tand delivering as {} ...".format(mqlZFile))
-        bzip(mqlUFile, mqlZFile)
+            if mqlCopy and (
+                not os.path.exists(mqlUFile)
+                or buildcache.fileHash(mqlUFile) != manifest["mql"]
+            ):
+                if os.path.exists(mqlUFile):
+                    os.unlink(mqlUFile)
+                caption(0, "\tunzipping into {}".format(mqlUFile))
+                os.makedirs(tempShebanqDir, exist_ok=True)
+                bunzip(mqlZFile, mqlUFile)
+        buildcache.saveHashIndex(location)
         caption(0, "\tDone")
 
     if "mysql" in kinds:
         caption(1, "Create Mysql passage db for version {}".format(version))
-        runNb(pipelineRepo, programDir, "passageFromTf", force=force, VERSION=version)
+        runNb(
+            pipelineRepo,
+            programDir,
+            "passageFromTf",
+            force=force,
+            shareTf=shareTf,
+            VERSION=version,
+            REPO_BASE=githubBase,
+            PASSAGE_FORMAT=passageFormat,
+            WORKERS=passageWorkers,
+        )
         caption(0, "\tDone")
 
     return True
 
 
-def importLocal(pipeline, versions=None, kinds={"mql", "mysql"}):
-    good = True
+def importLocal(
+    pipeline,
+    versions=None,
+    kinds={"mql", "mysql"},
+    passageFormat="sql",
+    concurrency=importConcurrency,
+    tables=None,
+):
     chosenVersions = (
         [] if versions is None else [versions] if type(versions) is str else versions
     )
-    for version in chosenVersions:
-        thisGood = importLocalSingle(pipeline, version, kinds=kinds)
-        if not thisGood:
-            good = False
-    return good
+    # the work is done by the importers, so threads are enough to keep them busy
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        results = list(
+            pool.map(
+                lambda version: importLocalSingle(
+                    pipeline,
+                    version,
+                    kinds=kinds,
+                    passageFormat=passageFormat,
+                    tables=tables,
+                ),
+                chosenVersions,
+            )
+        )
+    return all(results)
+
+
+def runFed(cmd, srcFile, label, cwd=None):
+    # run cmd with the contents of srcFile on its standard input,
+    # decompressed on the fly if it is a .bz2 or .gz file
+    if not os.path.exists(srcFile):
+        caption(0, "\tERROR: {} does not exist".format(srcFile))
+        return False
+    p = Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=STDOUT, cwd=cwd)
 
+    def relay():
+        for line in p.stdout:
+            caption(
+                0, "\t{}: {}".format(label, line.decode("utf8", "replace").rstrip())
+            )
 
-def importLocalSingle(pipeline, version, kinds={"mql", "mysql"}):
+    relayer = threading.Thread(target=relay, daemon=True)
+    relayer.start()
     good = True
+    total = os.path.getsize(srcFile)
+    with open(srcFile, "rb") as raw:
+        src = (
+            bz2.open(raw)
+            if srcFile.endswith(".bz2")
+            else gzip.open(raw)
+            if srcFile.endswith(".gz")
+            else raw
+        )
+        position = 0
+        try:
+            while True:
+                data = src.read(utils.chunkSize)
+                if not data:
+                    break
+                p.stdin.write(data)
+                utils.progress(label, raw.tell() - position, total=total, unit="bytes")
+                position = raw.tell()
+        except BrokenPipeError:
+            good = False
+        finally:
+            try:
+                p.stdin.close()
+            except BrokenPipeError:
+                good = False
+    p.wait()
+    relayer.join()
+    utils.progressDone(label)
+    return good and p.returncode == 0
 
-    if "mql" in kinds:
-        repoOrder = pipeline["repoOrder"].strip().split()
-        resultRepo = repoOrder[0]
 
-        dbName = "shebanq_etcbc{}".format(version)
-        dbDir = "{}/{}/shebanq/{}".format(githubBase, resultRepo, version)
+def importMql(dbName, mqlZFile):
+    caption(0, "\tDrop database {}".format(dbName))
+    if not run('{} -e "drop database if exists {};"'.format(mysqlCommand, dbName)):
+        caption(1, "Drop database failed for {}".format(dbName), good=False)
+        return False
+    caption(0, "\tImporting MQL {} ...".format(dbName))
+    if not runFed(mqlCommand, mqlZFile, dbName):
+        caption(1, "Import mql failed for {}".format(dbName), good=False)
+        return False
+    caption(1, "Imported MQL {}".format(dbName))
+    return True
 
-        caption(1, "Import MQL db for version {} locally".format(version))
-        dbDir = "{}/{}/_temp/{}/shebanq".format(githubBase, resultRepo, version)
-        dbName = "shebanq_etcbc{}".format(version)
-        caption(1, "Drop database {}".format(dbName))
-        if not run('mysql -u root -e "drop database if exists {};"'.format(dbName)):
-            caption(1, "Drop database failed for {}".format(dbName), good=False)
-            return False
-        caption(1, "Importing MQL {} ...".format(dbName))
-        if not run("mql -n -b m -u root -e UTF8 < {}/{}.mql".format(dbDir, dbName)):
-            caption(1, "Import mql failed for {}".format(dbName), good=False)
+
+def importPassage(pdbName, srcFile, cwd=None, options=""):
+    caption(0, "\tImporting passage db {} ...".format(pdbName))
+    if not runFed("{}{}".format(mysqlCommand, options), srcFile, pdbName, cwd=cwd):
+        caption(1, "Import mysql failed for {}".format(pdbName), good=False)
+        return False
+    caption(1, "Imported passage db {}".format(pdbName))
+    return True
+
+
+def importPassageTables(pdbName, tablesDir, tables):
+    # every table file drops and recreates its own table,
+    # the rest of the passage database is left as it is
+    for table in tables:
+        if not importPassage(
+            "{}.{}".format(pdbName, table), "{}/{}.sql.gz".format(tablesDir, table)
+        ):
             return False
-        caption(1, "Imported MQL {}".format(dbName))
+    return True
+
+
+def importLocalSingle(
+    pipeline, version, kinds={"mql", "mysql"}, passageFormat="sql", tables=None
+):
+    # the MQL and the passage database are imported at the same time,
+    # straight from the delivered compressed files;
+    # with tables, only those tables of the passage database are replaced,
+    # from the files per table that passageFromTf leaves in the temp dir
+    repoOrder = pipeline["repoOrder"].strip().split()
+    resultRepo = repoOrder[0]
+    shebanqDir = "{}/{}/shebanq/{}".format(githubBase, resultRepo, version)
+    dbDir = "{}/{}/_temp/{}/shebanq".format(githubBase, resultRepo, version)
+
+    caption(1, "Import databases for version {} locally".format(version))
+    jobs = []
+    if "mql" in kinds:
+        dbName = "shebanq_etcbc{}".format(version)
+        mqlZFile = "{}/{}.mql.bz2".format(shebanqDir, dbName)
+        jobs.append(lambda: importMql(dbName, mqlZFile))
 
     if "mysql" in kinds:
-        caption(1, "Importing passage db for version {} ...".format(version))
         pdbName = "shebanq_passage{}".format(version)
-        if not run("mysql -u root < {}/{}.sql".format(dbDir, pdbName)):
-            caption(1, "Import mysql failed for {}".format(pdbName), good=False)
-            return False
-        caption(1, "Imported passage db for version {}".format(version))
+        if passageFormat == "tsv":
+            # the load script refers to the data files next to it
+            bulkDir = "{}/{}".format(dbDir, pdbName)
+            jobs.append(
+                lambda: importPassage(
+                    pdbName,
+                    "{}/load.sql".format(bulkDir),
+                    cwd=bulkDir,
+                    options=" --local-infile=1",
+                )
+            )
+        elif passageFormat == "sqlite":
+            caption(
+                0,
+                "\tThe SQLite passage database needs no import: {}/{}.sqlite".format(
+                    dbDir, pdbName
+                ),
+            )
+        elif tables:
+            tablesDir = "{}/tables".format(dbDir)
+            jobs.append(lambda: importPassageTables(pdbName, tablesDir, tables))
+        else:
+            sqlZFile = "{}/{}.sql.gz".format(shebanqDir, pdbName)
+            jobs.append(lambda: importPassage(pdbName, sqlZFile))
 
-    return good
+    if not jobs:
+        return True
+    with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+        results = list(pool.map(lambda job: job(), jobs))
+    return all(results)
 
 
 def copyServer(
-    pipeline, user, server, remoteDir, versions=None, kinds={"mql", "mysql"}
+    pipeline,
+    user,
+    server,
+    remoteDir,
+    versions=None,
+    kinds={"mql", "mysql"},
+    passageFormat="sql",
+    transport=None,
+    workers=2,
 ):
     good = True
     chosenVersions = (
         [] if versions is None else [versions] if type(versions) is str else versions
     )
+    previous = None
     for version in chosenVersions:
         thisGood = copyServerSingle(
-            pipeline, user, server, remoteDir, version, kinds=kinds
+            pipeline,
+            user,
+            server,
+            remoteDir,
+            version,
+            kinds=kinds,
+            passageFormat=passageFormat,
+            transport=transport,
+            previous=previous,
+            workers=workers,
         )
         if not thisGood:
             good = False
+        previous = version
     return good
 
 
+def serverFiles(version, kinds, passageFormat):
+    files = []
+    if "mql" in kinds:
+        files.append("shebanq_etcbc{}.mql.bz2".format(version))
+    if "mysql" in kinds:
+        files.append(
+            "shebanq_passage{}.{}".format(
+                version, "tsv.tar.gz" if passageFormat == "tsv" else "sql.gz"
+            )
+        )
+    return files
+
+
 def copyServerSingle(
-    pipeline, user, server, remoteDir, version, kinds={"mql", "mysql"}
+    pipeline,
+    user,
+    server,
+    remoteDir,
+    version,
+    kinds={"mql", "mysql"},
+    passageFormat="sql",
+    transport=None,
+    previous=None,
+    workers=2,
 ):
+    # Only the blocks that are not on the server yet are sent,
+    # and when the files of the previous version are there, blocks are taken from them.
+    # transport defaults to ssh to user@server; see transfer.py for alternatives.
     repoOrder = pipeline["repoOrder"].strip().split()
     resultRepo = repoOrder[0]
 
     dbDir = "{}/{}/shebanq/{}".format(githubBase, resultRepo, version)
-    dbFile = "shebanq_etcbc{}.mql.bz2".format(version)
-    pdbFile = "shebanq_passage{}.sql.gz".format(version)
-    address = "{}@{}:{}".format(user, server, remoteDir)
+    if transport is None:
+        transport = transfer.sshTransport("{}@{}".format(user, server), remoteDir)
 
+    caption(1, "Sending databases for version {} to server".format(version))
     good = True
-    for theFile in (dbFile, pdbFile):
-        if theFile == dbFile and "mql" not in kinds:
-            continue
-        if theFile == pdbFile and "mysql" not in kinds:
+    names = serverFiles(version, kinds, passageFormat)
+    bases = (
+        [None] * len(names)
+        if previous is None
+        else serverFiles(previous, kinds, passageFormat)
+    )
+    files = []
+    for (theFile, basis) in zip(names, bases):
+        path = "{}/{}".format(dbDir, theFile)
+        if not os.path.exists(path):
+            caption(0, "\tERROR: {} does not exist".format(path))
+            good = False
             continue
-        if theFile == dbFile:
-            caption(1, "Sending MQL database for version {} to server".format(version))
-        else:
-            caption(
-                1, "Sending passage database for version {} to server".format(version)
-            )
         caption(0, "\t{}".format(theFile))
-        caption(0, "\tscp {}/{} {}/{}".format(dbDir, theFile, address, theFile))
-        if not run("scp {}/{} {}/{}".format(dbDir, theFile, address, theFile)):
-            good = False
-        caption(0, "\tdone")
+        files.append((path, theFile, basis))
+    if not transfer.sendFiles(transport, files, workers=workers):
+        good = False
+    caption(0, "\tdone")
     return good
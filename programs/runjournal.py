@@ -0,0 +1,84 @@
+import os
+import json
+from datetime import datetime
+
+import buildcache
+from utils import caption
+
+# The journal of a version: one JSON line per completed task,
+# with the hashes of its notebook, its parameters and its outputs.
+# Lines are flushed to disk as soon as a task is done,
+# so that an interrupted run can be resumed where it stopped.
+
+
+def _journalPath(journalDir, version):
+    return "{}/{}.jsonl".format(journalDir, version)
+
+
+def readJournal(journalDir, version):
+    records = {}
+    path = _journalPath(journalDir, version)
+    if not os.path.exists(path):
+        return records
+    with open(path) as fh:
+        for line in fh:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line may have been cut off by the interruption
+                continue
+            records[(record["repo"], record["task"])] = record
+    return records
+
+
+def startJournal(journalDir, version, nodes):
+    # a fresh run of these tasks: forget what we knew about them
+    path = _journalPath(journalDir, version)
+    if not os.path.exists(path):
+        return
+    records = readJournal(journalDir, version)
+    tempPath = "{}.{}".format(path, os.getpid())
+    with open(tempPath, "w") as fh:
+        for (node, record) in records.items():
+            if node not in nodes:
+                fh.write(json.dumps(record, sort_keys=True) + "\n")
+    os.replace(tempPath, path)
+
+
+def recordTask(journalDir, version, repo, task, nbFile, paramValues, outputs):
+    record = dict(
+        repo=repo,
+        task=task,
+        date=datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+        notebook=buildcache.fileHash(nbFile),
+        params=buildcache.paramHash(paramValues),
+        outputs=outputs,
+    )
+    os.makedirs(journalDir, exist_ok=True)
+    with open(_journalPath(journalDir, version), "a") as fh:
+        fh.write(json.dumps(record, sort_keys=True) + "\n")
+        fh.flush()
+        os.fsync(fh.fileno())
+
+
+def taskDone(records, base, repo, task, nbFile, paramValues):
+    # whether the task has completed with the same notebook and parameters,
+    # and its outputs are still as it left them
+    record = records.get((repo, task), None)
+    if record is None:
+        return False
+    if record["notebook"] != buildcache.fileHash(nbFile):
+        caption(0, "\t{}/{}: notebook changed since it ran".format(repo, task))
+        return False
+    if record["params"] != buildcache.paramHash(paramValues):
+        caption(0, "\t{}/{}: parameters changed since it ran".format(repo, task))
+        return False
+    for (rel, digest) in sorted(record["outputs"].items()):
+        path = "{}/{}".format(base, rel)
+        if not os.path.exists(path) or buildcache.fileHash(path) != digest:
+            caption(0, "\t{}/{}: output {} has changed".format(repo, task, rel))
+            return False
+    return True
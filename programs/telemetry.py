@@ -0,0 +1,258 @@
+import os
+import sys
+import time
+import json
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from utils import caption
+
+# Performance records of tasks, repos and versions, one JSON object per line.
+# Every run of the pipeline gets an id, which is passed to worker processes
+# through the environment.
+
+runVar = "PIPELINE_RUN"
+peakStack = []
+
+
+def newRun():
+    runId = "{}-{}".format(datetime.now().strftime("%Y-%m-%dT%H:%M:%S"), os.getpid())
+    os.environ[runVar] = runId
+    return runId
+
+
+def currentRun():
+    runId = os.environ.get(runVar, None)
+    return newRun() if runId is None else runId
+
+
+def _procValues(path):
+    values = {}
+    if not os.path.exists(path):
+        return values
+    with open(path) as fh:
+        for line in fh:
+            (key, sep, value) = line.partition(":")
+            if sep:
+                values[key.strip()] = value.strip()
+    return values
+
+
+def _currentPeak():
+    # peak resident set size in bytes since the last reset
+    hwm = _procValues("/proc/self/status").get("VmHWM", None)
+    if hwm is not None:
+        return int(hwm.split()[0]) * 1024
+    if resource is None:
+        return None
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxRss if sys.platform == "darwin" else maxRss * 1024
+
+
+def _resetPeak():
+    # only Linux lets us reset the peak, elsewhere it is the peak of the process so far
+    try:
+        with open("/proc/self/clear_refs", "w") as fh:
+            fh.write("5")
+    except OSError:
+        pass
+
+
+def _sample():
+    io = _procValues("/proc/self/io")
+    if resource is None:
+        cpu = time.process_time()
+    else:
+        cpu = 0
+        for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+            usage = resource.getrusage(who)
+            cpu += usage.ru_utime + usage.ru_stime
+    return dict(
+        wall=time.time(),
+        cpu=cpu,
+        read=int(io["rchar"]) if "rchar" in io else None,
+        written=int(io["wchar"]) if "wchar" in io else None,
+    )
+
+
+def startMeasure():
+    if peakStack:
+        peak = _currentPeak()
+        if peak is not None:
+            peakStack[-1] = max(peakStack[-1], peak)
+    peakStack.append(0)
+    _resetPeak()
+    return _sample()
+
+
+def endMeasure(start, historyFile, **info):
+    end = _sample()
+    peak = _currentPeak()
+    peak = max(peakStack.pop(), peak or 0) if peakStack else peak
+    if peakStack:
+        peakStack[-1] = max(peakStack[-1], peak)
+
+    def diff(key):
+        return None if start[key] is None or end[key] is None else end[key] - start[key]
+
+    record = dict(
+        run=currentRun(),
+        pid=os.getpid(),
+        start=datetime.fromtimestamp(start["wall"]).strftime("%Y-%m-%dT%H:%M:%S"),
+        wall=round(end["wall"] - start["wall"], 3),
+        cpu=round(end["cpu"] - start["cpu"], 3),
+        maxRss=peak,
+        readBytes=diff("read"),
+        writtenBytes=diff("written"),
+    )
+    record.update(info)
+    caption(
+        0,
+        "\twall {:.1f}s cpu {:.1f}s peak memory {} read {} written {}".format(
+            record["wall"],
+            record["cpu"],
+            _size(record["maxRss"]),
+            _size(record["readBytes"]),
+            _size(record["writtenBytes"]),
+        ),
+    )
+    os.makedirs(os.path.dirname(historyFile), exist_ok=True)
+    with open(historyFile, "a") as fh:
+        fh.write(json.dumps(record, sort_keys=True) + "\n")
+    return record
+
+
+def _size(n):
+    if n is None:
+        return "?"
+    for unit in ("B", "KB", "MB"):
+        if n < 1024:
+            return "{:.1f} {}".format(n, unit)
+        n /= 1024
+    return "{:.1f} GB".format(n)
+
+
+def readHistory(historyFile):
+    runs = {}
+    if not os.path.exists(historyFile):
+        return runs
+    with open(historyFile) as fh:
+        for line in fh:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            runs.setdefault(record["run"], []).append(record)
+    return runs
+
+
+def _recordKey(record):
+    return (
+        record.get("kind", ""),
+        record.get("version", "") or "",
+        record.get("repo", "") or "",
+        record.get("task", "") or "",
+    )
+
+
+def showRuns(historyFile):
+    runs = readHistory(historyFile)
+    caption(4, "Runs in {}".format(historyFile))
+    for runId in sorted(runs):
+        records = runs[runId]
+        tasks = [r for r in records if r.get("kind", None) == "task"]
+        failed = sum(1 for r in tasks if not r.get("good", True))
+        caption(
+            0,
+            "\t{} {:>4} tasks {:>3} failed {:>8.1f}s in tasks".format(
+                runId, len(tasks), failed, sum(r["wall"] for r in tasks)
+            ),
+        )
+
+
+def compareRuns(
+    historyFile, runA=None, runB=None, threshold=0.1, minWall=1, minRss=2**20
+):
+    # flags everything that has become slower or more memory hungry by more than
+    # threshold (a fraction), ignoring differences below minWall seconds and minRss bytes
+    runs = readHistory(historyFile)
+    runIds = sorted(runs)
+    if runB is None:
+        runB = runIds[-1] if runIds else None
+    if runA is None:
+        earlier = [r for r in runIds if runB is not None and r < runB]
+        runA = earlier[-1] if earlier else None
+    if runA not in runs or runB not in runs:
+        caption(0, "\tERROR: need two runs to compare, found {}".format(runIds))
+        return None
+
+    caption(4, "Compare run {} with run {}".format(runA, runB))
+    recordsA = {}
+    for record in runs[runA]:
+        recordsA[_recordKey(record)] = record
+
+    flagged = []
+    for record in sorted(runs[runB], key=_recordKey):
+        key = _recordKey(record)
+        old = recordsA.get(key, None)
+        if old is None:
+            continue
+        problems = []
+        for (field, minimum, fmt) in (
+            ("wall", minWall, "{:.1f}s"),
+            ("maxRss", minRss, None),
+        ):
+            (a, b) = (old.get(field, None), record.get(field, None))
+            if a is None or b is None or b - a < minimum:
+                continue
+            if a == 0 or (b - a) / a > threshold:
+                problems.append(
+                    "{} {} => {} (+{:.0%})".format(
+                        field,
+                        fmt.format(a) if fmt else _size(a),
+                        fmt.format(b) if fmt else _size(b),
+                        (b - a) / a if a else 1,
+                    )
+                )
+        label = "{:<8} {:<8} {:<12} {:<20}".format(*key)
+        if problems:
+            flagged.append((key, problems))
+            caption(0, "\tWORSE {} {}".format(label, "; ".join(problems)), good=False)
+        else:
+            caption(0, "\tOK    {}".format(label))
+    caption(0, "{} regressions".format(len(flagged)))
+    return flagged
+
+
+if __name__ == "__main__":
+    from pipeline import historyLocation
+
+    args = sys.argv[1:]
+    threshold = 0.1
+    if "--threshold" in args:
+        i = args.index("--threshold")
+        threshold = float(args[i + 1])
+        args = args[0:i] + args[i + 2 :]
+    command = args[0] if args else "runs"
+    if command == "runs":
+        showRuns(historyLocation())
+    elif command == "compare":
+        runIds = args[1:3] + [None] * (2 - len(args[1:3]))
+        flagged = compareRuns(
+            historyLocation(), runA=runIds[0], runB=runIds[1], threshold=threshold
+        )
+        sys.exit(0 if flagged == [] else 1)
+    else:
+        caption(
+            0,
+            "usage: python telemetry.py runs | compare [runA [runB]] "
+            "[--threshold fraction]",
+        )
+        sys.exit(2)
@@ -0,0 +1,226 @@
+import os
+import sys
+import json
+import shlex
+import hashlib
+from subprocess import Popen, PIPE
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import caption
+
+# Sending files to a directory on another machine, or on this one.
+# Files go in blocks, each with its checksum, into a hidden part file next to the target,
+# which is renamed to the target when all blocks are there and the whole file checks out.
+# An interrupted upload resumes with the blocks that are missing from the part file,
+# and blocks that the remote side already has (in the old version of the target,
+# or in another file that is given as basis) are copied there instead of sent.
+#
+# A transport says how to run the helper below on the other side:
+# directly with the local Python, or through ssh (or anything that behaves like it).
+
+blockSize = 4 * 1024 * 1024
+retries = 3
+
+helperScript = r"""
+import os, sys, json, hashlib
+
+def partPath(root, name):
+    return os.path.join(root, "." + name + ".part")
+
+def blockHashes(path, bs):
+    if not os.path.exists(path):
+        return dict(size=None, hashes=[])
+    hashes = []
+    with open(path, "rb") as fh:
+        while True:
+            data = fh.read(bs)
+            if not data:
+                break
+            hashes.append(hashlib.sha256(data).hexdigest())
+    return dict(size=os.path.getsize(path), hashes=hashes)
+
+def openPart(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return open(path, "r+b" if os.path.exists(path) else "w+b")
+
+def main(op, root, name, bs, *args):
+    bs = int(bs)
+    part = partPath(root, name)
+    target = os.path.join(root, name)
+    result = {}
+    if op == "hashes":
+        result = dict(
+            target=blockHashes(target, bs),
+            part=blockHashes(part, bs),
+            basis=blockHashes(os.path.join(root, args[0]), bs) if args else None,
+        )
+    elif op == "receive":
+        bad = []
+        with openPart(part) as fh:
+            while True:
+                header = sys.stdin.buffer.readline()
+                if not header:
+                    break
+                (offset, length, digest) = header.split()
+                data = sys.stdin.buffer.read(int(length))
+                if len(data) != int(length) or hashlib.sha256(data).hexdigest() != digest.decode():
+                    bad.append(int(offset))
+                    continue
+                fh.seek(int(offset))
+                fh.write(data)
+                fh.flush()
+            os.fsync(fh.fileno())
+        result = dict(bad=bad)
+    elif op == "copy":
+        basis = os.path.join(root, args[0])
+        offsets = json.loads(sys.stdin.read())
+        with open(basis, "rb") as src, openPart(part) as fh:
+            for offset in offsets:
+                src.seek(offset)
+                fh.seek(offset)
+                fh.write(src.read(bs))
+            fh.flush()
+            os.fsync(fh.fileno())
+        result = dict(copied=len(offsets))
+    elif op == "finish":
+        (size, digest) = (int(args[0]), args[1])
+        with openPart(part) as fh:
+            fh.truncate(size)
+        h = hashlib.sha256()
+        with open(part, "rb") as fh:
+            while True:
+                data = fh.read(bs)
+                if not data:
+                    break
+                h.update(data)
+        good = h.hexdigest() == digest
+        if good:
+            os.replace(part, target)
+        else:
+            os.unlink(part)
+        result = dict(good=good)
+    sys.stdout.write(json.dumps(result))
+
+main(*sys.argv[1:])
+"""
+
+
+def localTransport(root):
+    return dict(root=root, command=None, python=sys.executable)
+
+
+def sshTransport(address, root, command="ssh", python="python3"):
+    # command is the ssh program with its options;
+    # a stand-in such as "sh -c" with address None runs the helper locally through a shell
+    prefix = shlex.split(command) + ([] if address is None else [address])
+    return dict(root=root, command=prefix, python=python)
+
+
+def _helper(transport, op, name, *args, data=None):
+    argv = [transport["python"], "-c", helperScript, op, transport["root"], name]
+    argv += [str(blockSize)] + [str(a) for a in args]
+    if transport["command"] is not None:
+        argv = transport["command"] + [" ".join(shlex.quote(a) for a in argv)]
+    p = Popen(argv, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    try:
+        if data is not None:
+            for chunk in data:
+                p.stdin.write(chunk)
+        p.stdin.close()
+    except BrokenPipeError:
+        pass
+    out = p.stdout.read()
+    err = p.stderr.read()
+    p.wait()
+    if p.returncode != 0:
+        caption(0, "\tERROR: {} {}: {}".format(op, name, err.decode().strip()))
+        return None
+    return json.loads(out)
+
+
+def _localBlocks(path):
+    hashes = []
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        while True:
+            data = fh.read(blockSize)
+            if not data:
+                break
+            hashes.append(hashlib.sha256(data).hexdigest())
+            h.update(data)
+    return (hashes, h.hexdigest())
+
+
+def _frames(path, blocks, hashes):
+    with open(path, "rb") as fh:
+        for i in blocks:
+            fh.seek(i * blockSize)
+            data = fh.read(blockSize)
+            yield "{} {} {}\n".format(i * blockSize, len(data), hashes[i]).encode()
+            yield data
+
+
+def sendFile(transport, path, name, basis=None):
+    # returns whether the file has arrived intact at root/name on the other side
+    (hashes, digest) = _localBlocks(path)
+    size = os.path.getsize(path)
+    for attempt in range(retries):
+        remote = _helper(transport, "hashes", name, *([] if basis is None else [basis]))
+        if remote is None:
+            continue
+        if remote["target"]["size"] == size and remote["target"]["hashes"] == hashes:
+            caption(0, "\t{} is already there".format(name))
+            return True
+        # blocks come from the old target if there is one, otherwise from the basis
+        source = remote["target"] if remote["target"]["size"] is not None else None
+        sourceName = name if source is not None else None
+        if source is None and remote["basis"] is not None:
+            if remote["basis"]["size"] is not None:
+                (source, sourceName) = (remote["basis"], basis)
+        there = remote["part"]["hashes"]
+        copies = []
+        sends = []
+        for (i, h) in enumerate(hashes):
+            if i < len(there) and there[i] == h:
+                continue
+            if source is not None and i < len(source["hashes"]):
+                if source["hashes"][i] == h:
+                    copies.append(i * blockSize)
+                    continue
+            sends.append(i)
+        caption(
+            0,
+            "\t{}: {} blocks, {} in place, {} copied there, {} sent".format(
+                name,
+                len(hashes),
+                len(hashes) - len(copies) - len(sends),
+                len(copies),
+                len(sends),
+            ),
+        )
+        if copies:
+            data = [json.dumps(copies).encode()]
+            if _helper(transport, "copy", name, sourceName, data=data) is None:
+                continue
+        if sends:
+            result = _helper(
+                transport, "receive", name, data=_frames(path, sends, hashes)
+            )
+            if result is None or result["bad"]:
+                caption(0, "\t{}: not all blocks arrived, trying again".format(name))
+                continue
+        result = _helper(transport, "finish", name, size, digest)
+        if result is not None and result["good"]:
+            return True
+        caption(0, "\t{}: checksum does not match, trying again".format(name))
+    caption(0, "\tERROR: could not send {}".format(name), good=False)
+    return False
+
+
+def sendFiles(transport, files, workers=2):
+    # files is a list of (path, name, basis); they are sent in parallel
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        results = list(
+            pool.map(lambda f: sendFile(transport, f[0], f[1], basis=f[2]), files)
+        )
+    return all(results)
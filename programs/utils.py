@@ -10,94 +10,227 @@ import sys
 import os
 import time
 import bz2
+import collections
+import hashlib
 import gzip as gz
-from shutil import rmtree, copytree, copy
+import json
+import queue
+import atexit
+import threading
+import ctypes
+import multiprocessing
+from shutil import rmtree, copyfile, copystat, copyfileobj
 from itertools import zip_longest
 from glob import glob
+from concurrent.futures import ProcessPoolExecutor
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
-def bzip(uzFile, bzFile):
-    xB = os.path.exists(bzFile)
-    xU = os.path.exists(uzFile)
-    if not xU:
-        if xB:
+
+# Compression streams in chunks, so files of any size take constant memory.
+# With workers > 1 the input is cut in blocks that are compressed in parallel;
+# the result is a sequence of compressed streams, which is still a valid
+# .bz2 or .gz file.
+
+chunkSize = 1024 * 1024
+blockSize = 16 * 1024 * 1024
+
+
+def _mustConvert(srcFile, dstFile, srcName, dstName, action):
+    xS = os.path.exists(srcFile)
+    xD = os.path.exists(dstFile)
+    if not xS:
+        if xD:
             caption(
-                0, "\tWARNING: unzipped file is missing. Using existing bzipped file"
+                0,
+                "\tWARNING: {} file is missing. Using existing {} file".format(
+                    srcName, dstName
+                ),
             )
         else:
-            caption(0, "\tERROR: Cannot bzip because unzipped file is missing")
+            caption(
+                0,
+                "\tERROR: Cannot {} because {} file is missing".format(action, srcName),
+            )
+        return False
+    if not xD or os.path.getmtime(srcFile) > os.path.getmtime(dstFile):
+        return True
+    caption(
+        0,
+        "\tNOTE: Using existing {} file which is newer than {} one".format(
+            dstName, srcName
+        ),
+    )
+    return False
+
+
+def _compressBlock(job):
+    (compress, data) = job
+    return bz2.compress(data) if compress == "bz2" else gz.compress(data)
+
+
+def _chunks(fh, size):
+    while True:
+        data = fh.read(size)
+        if not data:
+            break
+        yield data
+
+
+def _compress(src, dst, compress, workers=None, sinks=(), pool=None):
+    # compress the open file src into the open file dst,
+    # and hand every uncompressed chunk to the sinks as well
+    if pool is None and (workers is None or workers <= 1):
+        opener = bz2.open if compress == "bz2" else gz.open
+        with opener(dst, mode="wb") as zDst:
+            for data in _chunks(src, chunkSize):
+                zDst.write(data)
+                for sink in sinks:
+                    sink(data)
         return
-    if not xB or os.path.getmtime(uzFile) > os.path.getmtime(bzFile):
-        with bz2.open(bzFile, mode="wt") as bdata:
-            with open(uzFile, "r") as udata:
-                bdata.write(udata.read())
-    else:
-        caption(
-            0, "\tNOTE: Using existing bzipped file which is newer than unzipped one"
-        )
+    ownPool = pool is None
+    if ownPool:
+        pool = ProcessPoolExecutor(max_workers=workers)
+    try:
+        # keep a bounded number of blocks in flight
+        pending = []
+        for data in _chunks(src, blockSize):
+            pending.append(pool.submit(_compressBlock, (compress, data)))
+            for sink in sinks:
+                sink(data)
+            if len(pending) >= 2 * workers:
+                dst.write(pending.pop(0).result())
+        for future in pending:
+            dst.write(future.result())
+    finally:
+        if ownPool:
+            pool.shutdown()
+
+
+def _convert(srcFile, dstFile, opener, compress=None, workers=None):
+    # write to a temporary file first, so that an interrupted run
+    # does not leave a truncated file that looks newer than its source
+    tempFile = "{}.{}".format(dstFile, os.getpid())
+    try:
+        if compress is None:
+            with opener(srcFile, mode="rb") as src, open(tempFile, "wb") as dst:
+                copyfileobj(src, dst, chunkSize)
+        else:
+            with open(srcFile, "rb") as src, open(tempFile, "wb") as dst:
+                _compress(src, dst, compress, workers=workers)
+        os.replace(tempFile, dstFile)
+    finally:
+        if os.path.exists(tempFile):
+            os.unlink(tempFile)
+
+
+def bzip(uzFile, bzFile, workers=None):
+    if _mustConvert(uzFile, bzFile, "unzipped", "bzipped", "bzip"):
+        _convert(uzFile, bzFile, bz2.open, compress="bz2", workers=workers)
 
 
 def bunzip(bzFile, uzFile):
-    xB = os.path.exists(bzFile)
-    xU = os.path.exists(uzFile)
-    if not xB:
-        if xU:
-            caption(
-                0, "\tWARNING: bzipped file is missing. Using existing unzipped file"
-            )
-        else:
-            caption(0, "\tERROR: Cannot unzip because bzipped file is missing")
-        return
-    if not xU or os.path.getmtime(bzFile) > os.path.getmtime(uzFile):
-        with bz2.open(bzFile, mode="rt") as bdata:
-            with open(uzFile, "w") as udata:
-                udata.write(bdata.read())
-    else:
-        caption(
-            0, "\tNOTE: Using existing unzipped file which is newer than bzipped one"
-        )
+    if _mustConvert(bzFile, uzFile, "bzipped", "unzipped", "unzip"):
+        _convert(bzFile, uzFile, bz2.open)
 
 
-def gzip(uzFile, gzFile):
-    xB = os.path.exists(gzFile)
-    xU = os.path.exists(uzFile)
-    if not xU:
-        if xB:
-            caption(
-                0, "\tWARNING: unzipped file is missing. Using existing gzipped file"
-            )
-        else:
-            caption(0, "\tERROR: Cannot gzip because unzipped file is missing")
-        return
-    if not xB or os.path.getmtime(uzFile) > os.path.getmtime(gzFile):
-        with gz.open(gzFile, mode="wt") as gdata:
-            with open(uzFile, "rt") as udata:
-                gdata.write(udata.read())
-    else:
-        caption(
-            0, "\tNOTE: Using existing gzipped file which is newer than unzipped one"
-        )
+def gzip(uzFile, gzFile, workers=None):
+    if _mustConvert(uzFile, gzFile, "unzipped", "gzipped", "gzip"):
+        _convert(uzFile, gzFile, gz.open, compress="gz", workers=workers)
 
 
 def gunzip(gzFile, uzFile):
-    xB = os.path.exists(gzFile)
-    xU = os.path.exists(uzFile)
-    if not xB:
-        if xU:
-            caption(
-                0, "\tWARNING: gzipped file is missing. Using existing unzipped file"
-            )
-        else:
-            caption(0, "\tERROR: Cannot unzip because gzipped file is missing")
+    if _mustConvert(gzFile, uzFile, "gzipped", "unzipped", "unzip"):
+        _convert(gzFile, uzFile, gz.open)
+
+
+def _releasePipe(path):
+    # a reader that still waits for a writer gets end of file
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+    except OSError:
         return
-    if not xU or os.path.getmtime(gzFile) > os.path.getmtime(uzFile):
-        with gz.open(gzFile, mode="rt") as gdata:
-            with open(uzFile, "w") as udata:
-                udata.write(gdata.read())
-    else:
-        caption(
-            0, "\tNOTE: Using existing unzipped file which is newer than gzipped one"
-        )
+    os.close(fd)
+
+
+def bzipFrom(produce, fileName, bzFile, uzFile=None, workers=None):
+    # produce(directory) writes the file fileName into directory.
+    # That file is a pipe, which is compressed into bzFile while it is being written,
+    # and copied into uzFile if that is given, so the data passes through only once.
+    # Where there are no named pipes, the file is written and then compressed.
+    # Returns the sha256 of the uncompressed data, or None if there was none.
+    stageDir = "{}/.{}.{}".format(os.path.dirname(bzFile) or ".", fileName, os.getpid())
+    path = "{}/{}".format(stageDir, fileName)
+    tempBz = "{}.{}".format(bzFile, os.getpid())
+    tempUz = None if uzFile is None else "{}.{}".format(uzFile, os.getpid())
+    streaming = hasattr(os, "mkfifo")
+    outcome = dict(size=0, error=None)
+    h = hashlib.sha256()
+
+    def count(data):
+        outcome["size"] += len(data)
+
+    def consume():
+        with open(path, "rb") as src:
+            uzFh = None
+            try:
+                uzFh = None if tempUz is None else open(tempUz, "wb")
+                sinks = [h.update, count] + ([] if uzFh is None else [uzFh.write])
+                with open(tempBz, "wb") as dst:
+                    _compress(src, dst, "bz2", workers=workers, sinks=sinks, pool=pool)
+            except Exception as e:
+                outcome["error"] = e
+                # keep the producer going, it must not block on a full pipe
+                for data in _chunks(src, chunkSize):
+                    pass
+            finally:
+                if uzFh is not None:
+                    uzFh.close()
+
+    if os.path.exists(stageDir):
+        rmtree(stageDir)
+    os.makedirs(stageDir)
+    pool = None
+    if workers is not None and workers > 1:
+        # start the compressing processes before the pipe is opened,
+        # otherwise they inherit its writing end and it never reaches its end
+        pool = ProcessPoolExecutor(max_workers=workers)
+        pool.submit(len, b"").result()
+    try:
+        if streaming:
+            os.mkfifo(path)
+            reader = threading.Thread(target=consume, daemon=True)
+            reader.start()
+            try:
+                produce(stageDir)
+            finally:
+                while reader.is_alive():
+                    _releasePipe(path)
+                    reader.join(0.1)
+        else:
+            produce(stageDir)
+            if os.path.exists(path):
+                consume()
+        if outcome["error"] is not None:
+            caption(0, "\tERROR: compressing {}: {}".format(bzFile, outcome["error"]))
+            return None
+        if outcome["size"] == 0:
+            caption(0, "\tERROR: no data for {}".format(bzFile))
+            return None
+        os.replace(tempBz, bzFile)
+        if tempUz is not None:
+            os.replace(tempUz, uzFile)
+        return h.hexdigest()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        rmtree(stageDir, ignore_errors=True)
+        for tempFile in (tempBz, tempUz):
+            if tempFile is not None and os.path.exists(tempFile):
+                os.unlink(tempFile)
 
 
 timestamp = None
@@ -121,66 +254,308 @@ def _duration():
     )
 
 
+# Output of caption() is not flushed on every call, but by a background thread,
+# a few times per second, and before every message on stderr.
+# verbosity: 0 = only failures, 1 = also headings, 2 = everything.
+# If logFile is set (or PIPELINE_LOG), every message also goes as a JSON line
+# to that file, written by a thread of its own.
+
+verbosity = int(os.environ.get("PIPELINE_VERBOSITY", "2"))
+flushInterval = 0.5
+progressInterval = 2.0
+logFile = os.environ.get("PIPELINE_LOG", None)
+
+outputState = dict(
+    started=False,
+    dirty=False,
+    wake=None,
+    flushThread=None,
+    logQueue=None,
+    logThread=None,
+)
+progressState = {}
+
+# the fixed lines of the banners of pipeline and repo level headings
+banners = {
+    level: (c, "{0}{0}{1}{0}{0}".format(c, c * 90), "{} {} {}".format(c, " " * 90, c))
+    for (level, c) in ((1, "#"), (2, "*"))
+}
+
+
+def _flusher(wake):
+    while True:
+        wake.wait(flushInterval)
+        wake.clear()
+        if outputState["dirty"]:
+            outputState["dirty"] = False
+            sys.stdout.flush()
+
+
+def _logWriter(logQueue, path):
+    with open(path, "a") as fh:
+        while True:
+            record = logQueue.get()
+            if record is None:
+                break
+            fh.write(json.dumps(record, ensure_ascii=False) + "\n")
+            if logQueue.empty():
+                fh.flush()
+
+
+def _startOutput():
+    # start the background threads that are not running (yet):
+    # the flusher runs for good, the log writer stops at every flush(),
+    # in a forked process they start again
+    outputState["started"] = True
+    flushThread = outputState["flushThread"]
+    if flushThread is None or not flushThread.is_alive():
+        outputState["dirty"] = False
+        wake = threading.Event()
+        outputState["wake"] = wake
+        flushThread = threading.Thread(target=_flusher, args=(wake,), daemon=True)
+        flushThread.start()
+        outputState["flushThread"] = flushThread
+    if logFile is not None and outputState["logQueue"] is None:
+        logQueue = queue.Queue()
+        thread = threading.Thread(
+            target=_logWriter, args=(logQueue, logFile), daemon=True
+        )
+        thread.start()
+        outputState["logQueue"] = logQueue
+        outputState["logThread"] = thread
+
+
+def _resetOutput():
+    # the threads of the parent do not run in a forked child
+    outputState["started"] = False
+    outputState["logQueue"] = None
+    outputState["logThread"] = None
+
+
+def flush():
+    if not outputState["started"]:
+        return
+    outputState["dirty"] = False
+    sys.stdout.flush()
+    sys.stderr.flush()
+    logQueue = outputState["logQueue"]
+    if logQueue is not None:
+        logQueue.put(None)
+        outputState["logThread"].join()
+        outputState["logQueue"] = None
+        outputState["started"] = False
+
+
+atexit.register(flush)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_resetOutput)
+
+
 def caption(level, heading, good=None, newLine=True, continuation=False):
+    if not outputState["started"]:
+        _startOutput()
+    if outputState["logQueue"] is not None:
+        outputState["logQueue"].put(
+            dict(
+                time=time.time(),
+                pid=os.getpid(),
+                level=level,
+                good=good,
+                continuation=continuation,
+                message=heading,
+            )
+        )
+    if good is not False and (verbosity < 1 or (verbosity < 2 and level == 0)):
+        return
+
     channel = sys.stdout if good is None or good else sys.stderr
     prefix = "" if good is None else "SUCCES " if good else "FAILURE "
-    duration = "" if continuation else "{:>11} ".format(_duration())
-    reportHeading = "{}{}{}".format(duration, prefix, heading)
+    if continuation:
+        reportHeading = prefix + heading
+    else:
+        reportHeading = "{:>11} {}{}".format(_duration(), prefix, heading)
 
     if level == 0:  # non-heading message
-        decoration = "" if continuation else "| "
-        formattedString = """{}{}""".format(decoration, reportHeading)
-    elif level == 1:  # pipeline level
-        formattedString = """
-##{}##
-# {} #
-# {} #
-# {} #
-##{}##
-""".format(
-            "#" * 90,
-            " " * 90,
-            "{:<90}".format(reportHeading),
-            " " * 90,
-            "#" * 90,
-        )
-    elif level == 2:  # repo level
-        formattedString = """
-**{}**
-* {} *
-* {} *
-* {} *
-**{}**
-""".format(
-            "*" * 90,
-            " " * 90,
-            "{:<90}".format(reportHeading),
-            " " * 90,
-            "*" * 90,
+        formattedString = reportHeading if continuation else "| " + reportHeading
+    elif level in banners:  # pipeline level, repo level
+        (c, edge, blank) = banners[level]
+        formattedString = "\n{1}\n{2}\n{0} {3:<90} {0}\n{2}\n{1}\n".format(
+            c, edge, blank, reportHeading
         )
     elif level == 3:  # task level
         formattedString = """
 --{}--
-- {} -
+- {:<90} -
 --{}--
 """.format(
             "-" * 90,
-            "{:<90}".format(reportHeading),
+            reportHeading,
             "-" * 90,
         )
     elif level == 4:  # caption within task execution
         formattedString = """..{}..
-. {} .
+. {:<90} .
 ..{}..""".format(
             "." * 90,
-            "{:<90}".format(reportHeading),
+            reportHeading,
             "." * 90,
         )
+    if channel is sys.stderr:
+        # keep the order of stdout and stderr messages
+        sys.stdout.flush()
     if newLine:
         channel.write(formattedString + "\n")
     else:
         channel.write(formattedString)
-    channel.flush()
+    if channel is sys.stderr:
+        channel.flush()
+    else:
+        outputState["dirty"] = True
+        if level in {1, 2, 3}:
+            outputState["wake"].set()
+
+
+def _amount(n, unit):
+    if unit != "bytes":
+        return str(n)
+    for u in ("B", "KB", "MB"):
+        if n < 1024:
+            return "{:.1f} {}".format(n, u)
+        n /= 1024
+    return "{:.1f} GB".format(n)
+
+
+def _progressRep(label, state, total):
+    (n, lastReport, start, unit) = state
+    rep = "\t{} {}{}".format(
+        label,
+        _amount(n, unit),
+        "" if total is None else " of {}".format(_amount(total, unit)),
+    )
+    elapsed = time.time() - start
+    if unit == "bytes" and elapsed > 0:
+        rep += " at {}/s".format(_amount(n / elapsed, unit))
+    return rep
+
+
+def progress(label, step=1, total=None, unit=None):
+    # call this in a loop: it reports the count at most once every progressInterval seconds
+    # with unit="bytes" the count is shown as a size, with the throughput so far
+    now = time.time()
+    state = progressState.get(label, None)
+    if state is None:
+        state = [0, now, now, unit]
+        progressState[label] = state
+    state[0] += step
+    if now - state[1] >= progressInterval:
+        state[1] = now
+        caption(0, _progressRep(label, state, total))
+
+
+def progressDone(label):
+    state = progressState.pop(label, None)
+    if state is None:
+        caption(0, "\t{} 0 done".format(label))
+    else:
+        caption(0, "{} done".format(_progressRep(label, state, None)))
+
+
+# Running a function over items in forked worker processes.
+# The workers share the memory of this process as it is when the pool starts,
+# e.g. a loaded Text-Fabric dataset, and the function need not be importable:
+# it may be defined in a notebook.
+# The results come in the order of the items.
+
+_forked = None
+
+
+def _runForked(item):
+    return _forked(item)
+
+
+def forkMap(function, items, workers=None):
+    global _forked
+    _forked = function
+    nWorkers = os.cpu_count() if workers is None else workers
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=nWorkers, mp_context=context) as pool:
+        for result in pool.map(_runForked, items):
+            yield result
+
+
+# Text-Fabric datasets that stay loaded between the tasks of a pipeline run.
+# The pipeline switches sharing on by setting shareTf.
+# A shared dataset is reloaded when one of its feature files has been written in the meantime.
+
+shareTf = False
+tfCacheLimit = 2
+tfCache = {}
+
+
+def _tfDirs(locations, modules):
+    locations = [locations] if type(locations) is str else locations
+    modules = [modules] if type(modules) is str else modules
+    return tuple(
+        os.path.normpath(os.path.expanduser("{}/{}".format(loc, mod) if mod else loc))
+        for loc in locations
+        for mod in modules
+    )
+
+
+def _tfStamp(tfDirs):
+    stamp = []
+    for tfDir in tfDirs:
+        if not os.path.isdir(tfDir):
+            continue
+        with os.scandir(tfDir) as tfIt:
+            for tfEntry in tfIt:
+                if tfEntry.is_file() and tfEntry.name.endswith(".tf"):
+                    st = tfEntry.stat()
+                    stamp.append((tfDir, tfEntry.name, st.st_size, st.st_mtime_ns))
+    return tuple(sorted(stamp))
+
+
+def loadTf(locations, modules, features, share=None):
+    from tf.fabric import Fabric
+
+    if share is None:
+        share = shareTf
+    if not share:
+        TF = Fabric(locations=locations, modules=modules)
+        return TF.load(features)
+
+    key = _tfDirs(locations, modules)
+    stamp = _tfStamp(key)
+    cached = tfCache.pop(key, None)
+    if cached is not None and cached["stamp"] != stamp:
+        caption(0, "\tTF data has been changed since it was loaded, loading it afresh")
+        cached = None
+    if cached is None:
+        cached = dict(
+            TF=Fabric(locations=locations, modules=modules),
+            stamp=stamp,
+            api=None,
+            loaded=set(),
+        )
+    wanted = set(features.strip().split() if type(features) is str else features)
+    missing = wanted - cached["loaded"]
+    if cached["api"] is None:
+        api = cached["TF"].load(" ".join(sorted(missing)))
+        if not api:
+            return api
+        cached["api"] = api
+    elif missing:
+        caption(0, "\tAdding {} features to the shared TF data".format(len(missing)))
+        if not cached["TF"].load(" ".join(sorted(missing)), add=True):
+            return False
+    else:
+        caption(0, "\tUsing shared TF data")
+    cached["loaded"] |= missing
+
+    tfCache[key] = cached
+    while len(tfCache) > tfCacheLimit:
+        del tfCache[next(iter(tfCache))]
+    return cached["api"]
 
 
 def mustRun(fileIn, fileOut, force=False):
@@ -228,49 +603,206 @@ def mustRun(fileIn, fileOut, force=False):
     return (good, work or force)
 
 
-def checkDiffs(thisSave, thisDeliver, only=None):
-    def diffFeature(f):
-        caption(0, "{:<25} ... ".format(f), newLine=False)
-        existingPath = "{}/{}.tf".format(thisDeliver, f)
-        newPath = "{}/{}.tf".format(thisSave, f)
-        with open(existingPath) as h:
-            eLines = (
-                h.readlines()
-                if f == "otext"
-                else (d for d in h.readlines() if not d.startswith("@"))
-            )
-        with open(newPath) as h:
-            nLines = (
-                h.readlines()
-                if f == "otext"
-                else (d for d in h.readlines() if not d.startswith("@"))
-            )
-        i = 0
-        equal = True
-        cutOff = 40
-        limit = 4
-        nUnequal = 0
-        for (e, n) in zip_longest(eLines, nLines, fillvalue="<empty>"):
-            i += 1
-            if e != n:
-                if nUnequal == 0:
-                    caption(
-                        0,
-                        "differences{}".format(
-                            "" if f == "otext" else " after the metadata"
-                        ),
-                        continuation=True,
-                    )
-                shortE = e[0:cutOff] + (" ..." if len(e) > cutOff else "")
-                shortN = n[0:cutOff] + (" ..." if len(n) > cutOff else "")
-                caption(0, "\tline {:>6} OLD -->{}<--".format(i, shortE.rstrip("\n")))
-                caption(0, "\tline {:>6} NEW -->{}<--".format(i, shortN.rstrip("\n")))
-                equal = False
-                nUnequal += 1
-                if nUnequal >= limit:
-                    break
+def _featureLines(path, whole):
+    # the lines of a feature file, without the metadata unless whole is True
+    with open(path, "rb") as h:
+        for line in h:
+            if whole or not line.startswith(b"@"):
+                yield line
+
+
+def _featureHash(path, whole):
+    h = hashlib.sha256()
+    for line in _featureLines(path, whole):
+        h.update(line)
+    return h.digest()
+
+
+def _featureDiffs(existingPath, newPath, whole, cutOff=40, limit=4):
+    # the first few lines where the two feature files differ
+    diffs = []
+    empty = b"<empty>"
+    for (i, (e, n)) in enumerate(
+        zip_longest(
+            _featureLines(existingPath, whole),
+            _featureLines(newPath, whole),
+            fillvalue=empty,
+        ),
+        start=1,
+    ):
+        if e == n:
+            continue
+        (e, n) = (e.decode("utf8", "replace"), n.decode("utf8", "replace"))
+        shortE = e[0:cutOff] + (" ..." if len(e) > cutOff else "")
+        shortN = n[0:cutOff] + (" ..." if len(n) > cutOff else "")
+        diffs.append((i, shortE.rstrip("\n"), shortN.rstrip("\n")))
+        if len(diffs) >= limit:
+            break
+    return diffs
+
+
+def _specRanges(spec):
+    # a TF node specification like 1-3,5 as a list of (first, last) pairs
+    ranges = []
+    for part in spec.split(","):
+        (b, sep, e) = part.partition("-")
+        (b, e) = (int(b), int(e) if sep else int(b))
+        ranges.append((b, e) if b <= e else (e, b))
+    return ranges
+
+
+def _nodeSpec(nodes):
+    # a sorted list of nodes as a TF node specification like 1-3,5
+    parts = []
+    for n in nodes:
+        if parts and n == parts[-1][1] + 1:
+            parts[-1][1] = n
+        else:
+            parts.append([n, n])
+    return ",".join(str(b) if b == e else "{}-{}".format(b, e) for (b, e) in parts)
+
+
+def _featureData(path):
+    # the data of a feature file as a mapping from nodes to values,
+    # where the value of an edge feature is a mapping from its targets to their values,
+    # which are None if the edges have no values; values are kept in their TF encoding
+    data = {}
+    isEdge = False
+    edgeValues = False
+    isInt = False
+    implicit = 1
+    with open(path, encoding="utf8") as h:
+        for line in h:
+            if line.startswith("@"):
+                header = line.strip()
+                if header == "@edge":
+                    isEdge = True
+                elif header == "@edgeValues":
+                    edgeValues = True
+                elif header == "@valueType=int":
+                    isInt = True
+                continue
+            break
+        nFields = 3 if isEdge and edgeValues else 2
+        for line in h:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) == 1 and not isEdge:
+                # by far the most frequent case
+                value = fields[0]
+                if isInt:
+                    if value != "":
+                        data[implicit] = str(int(value))
+                else:
+                    data[implicit] = value
+                implicit += 1
+                continue
+            if len(fields) == nFields:
+                ranges = _specRanges(fields[0])
+                fields = fields[1:]
+            else:
+                ranges = [(implicit, implicit)]
+            implicit = max(e for (b, e) in ranges) + 1
+            if isEdge:
+                value = fields[1] if edgeValues and len(fields) > 1 else None
+                targets = {
+                    t: value
+                    for (b, e) in _specRanges(fields[0])
+                    for t in range(b, e + 1)
+                }
+                for (b, e) in ranges:
+                    for n in range(b, e + 1):
+                        data.setdefault(n, {}).update(targets)
+                continue
+            value = fields[0] if fields else ""
+            if isInt:
+                if value == "":
+                    continue
+                value = str(int(value))
+            for (b, e) in ranges:
+                for n in range(b, e + 1):
+                    data[n] = value
+    return (isEdge, data)
+
+
+def _edgeText(targets):
+    # the targets of an edge in a fixed form: a node specification per value
+    byValue = collections.defaultdict(list)
+    for (t, value) in sorted(targets.items()):
+        byValue[value].append(t)
+    return ";".join(
+        _nodeSpec(nodes) if value is None else "{}\t{}".format(_nodeSpec(nodes), value)
+        for (value, nodes) in sorted(byValue.items(), key=lambda x: x[1][0])
+    )
+
+
+def _nodeDiffs(existingPath, newPath, examples=3, top=5):
+    # counts and value histograms of the added, removed and changed nodes
+    (isEdge, old) = _featureData(existingPath)
+    (isEdge, new) = _featureData(newPath)
+    added = collections.Counter()
+    removed = collections.Counter()
+    changed = collections.Counter()
+    nodes = dict(added=[], removed=[], changed=[])
+    for (n, value) in new.items():
+        oldValue = old.pop(n, None)
+        if oldValue is None:
+            added[_edgeText(value) if isEdge else value] += 1
+            kind = "added"
+        elif oldValue != value:
+            changed[
+                (_edgeText(oldValue), _edgeText(value)) if isEdge else (oldValue, value)
+            ] += 1
+            kind = "changed"
+        else:
+            continue
+        if len(nodes[kind]) < examples:
+            nodes[kind].append(n)
+    for (n, value) in old.items():
+        removed[_edgeText(value) if isEdge else value] += 1
+        if len(nodes["removed"]) < examples:
+            nodes["removed"].append(n)
+    return dict(
+        added=(sum(added.values()), added.most_common(top), sorted(nodes["added"])),
+        removed=(
+            sum(removed.values()),
+            removed.most_common(top),
+            sorted(nodes["removed"]),
+        ),
+        changed=(
+            sum(changed.values()),
+            changed.most_common(top),
+            sorted(nodes["changed"]),
+        ),
+    )
+
 
-        caption(0, "no changes" if equal else "", continuation=True)
+def _compareFeature(existingPath, newPath, whole, semantic):
+    if semantic and not whole:
+        return ("nodes", _nodeDiffs(existingPath, newPath))
+    return ("lines", _featureDiffs(existingPath, newPath, whole))
+
+
+def _showValue(value, cutOff=40):
+    value = value.replace("\t", " => ")
+    return value[0:cutOff] + (" ..." if len(value) > cutOff else "")
+
+
+def checkDiffs(thisSave, thisDeliver, only=None, workers=None, semantic=False):
+    # Features whose data have the same hash are equal, they need no line by line comparison.
+    # The other ones are compared in parallel, and reported in order.
+    # With semantic=True they are compared node by node instead of line by line.
+    def paths(f):
+        return ("{}/{}.tf".format(thisDeliver, f), "{}/{}.tf".format(thisSave, f))
+
+    def diffFeatures(features):
+        jobs = [paths(f) + (f == "otext", semantic) for f in features]
+        nWorkers = os.cpu_count() if workers is None else workers
+        if nWorkers > 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(max_workers=min(nWorkers, len(jobs))) as pool:
+                results = list(pool.map(_compareFeature, *zip(*jobs)))
+        else:
+            results = [_compareFeature(*job) for job in jobs]
+        return dict(zip(features, results))
 
     caption(4, "Check differences with previous version")
     existingFiles = glob("{}/*.tf".format(thisDeliver))
@@ -300,34 +832,192 @@ def checkDiffs(thisSave, thisDeliver, only=None):
         caption(0, "\tno features to delete")
 
     caption(0, "\t{} features in common".format(len(commonOnes)))
+    changed = [
+        f
+        for f in sorted(commonOnes)
+        if _featureHash(paths(f)[0], f == "otext")
+        != _featureHash(paths(f)[1], f == "otext")
+    ]
+    diffs = diffFeatures(changed)
     for f in sorted(commonOnes):
-        diffFeature(f)
+        caption(0, "{:<25} ... ".format(f), newLine=False)
+        if f not in diffs:
+            caption(0, "no changes", continuation=True)
+            continue
+        (kind, result) = diffs[f]
+        if kind == "nodes":
+            caption(
+                0,
+                ", ".join(
+                    "{} {}".format(result[x][0], x)
+                    for x in ("added", "removed", "changed")
+                ),
+                continuation=True,
+            )
+            for x in ("added", "removed", "changed"):
+                (amount, histogram, examples) = result[x]
+                if not amount:
+                    continue
+                caption(
+                    0,
+                    "\t{:<7} nodes {}{}".format(
+                        x,
+                        ", ".join(str(n) for n in examples),
+                        " ..." if amount > len(examples) else "",
+                    ),
+                )
+                for (value, n) in histogram:
+                    caption(
+                        0,
+                        "\t\t{:>7}x -->{}<--".format(
+                            n,
+                            "{}<-- ==> -->{}".format(
+                                _showValue(value[0]), _showValue(value[1])
+                            )
+                            if x == "changed"
+                            else _showValue(value),
+                        ),
+                    )
+            continue
+        caption(
+            0,
+            "differences{}".format("" if f == "otext" else " after the metadata"),
+            continuation=True,
+        )
+        for (i, shortE, shortN) in result:
+            caption(0, "\tline {:>6} OLD -->{}<--".format(i, shortE))
+            caption(0, "\tline {:>6} NEW -->{}<--".format(i, shortN))
+        caption(0, "", continuation=True)
     caption(0, "Done")
 
 
+# Delivery builds the new tree next to the target, and swaps it in at once,
+# so that readers never see a missing or half written data set.
+# Files that are already in the target with the same content are hard linked,
+# only new and changed files are written, by reflink where the file system can.
+# Sources are never hard linked: the programs that made them may overwrite them
+# in place later on, and that would change the delivered data as well.
+
+FICLONE = 0x40049409
+RENAME_EXCHANGE = 2
+AT_FDCWD = -100
+
+
+def treeFiles(top):
+    files = {}
+    if not os.path.isdir(top):
+        return files
+    for (root, dirs, names) in os.walk(top):
+        for name in names:
+            path = "{}/{}".format(root, name)
+            files[os.path.relpath(path, top)] = path
+    return files
+
+
+def _reflinkOrCopy(src, dst):
+    try:
+        if fcntl is None:
+            raise OSError("no reflinks")
+        with open(src, "rb") as fs, open(dst, "wb") as fd:
+            fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+    except OSError:
+        copyfile(src, dst)
+    copystat(src, dst)
+
+
+def _exchange(staging, target):
+    # atomically swap two directories (Linux), returns False if that is not possible
+    try:
+        renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+    except (OSError, AttributeError, TypeError):
+        return False
+    result = renameat2(
+        AT_FDCWD,
+        os.fsencode(staging),
+        AT_FDCWD,
+        os.fsencode(target),
+        RENAME_EXCHANGE,
+    )
+    return result == 0
+
+
+def _sameContent(src, cur):
+    # sizes first; content hashes are remembered by buildcache (when its index is loaded)
+    # under size and modification time, so the live target is normally not read again
+    import buildcache  # not at the top: buildcache imports utils
+
+    if os.path.samefile(src, cur):
+        return True
+    if os.path.getsize(src) != os.path.getsize(cur):
+        return False
+    return buildcache.fileHash(src) == buildcache.fileHash(cur)
+
+
+def deliverTree(files, target, prepare=None):
+    # files maps relative paths to the source files that make up the new target;
+    # a file that the target has with the same content keeps its inode, mtime included,
+    # the others are reflinked or copied from their sources.
+    # prepare(stagingDir) may adapt the new tree before it is swapped in;
+    # it should replace files, not write into them,
+    # since they may be links to the files of the live target.
+    target = target.rstrip("/")
+    # staging and old trees go next to the target, also if it is a bare relative path
+    parent = os.path.dirname(os.path.abspath(target))
+    name = os.path.basename(target)
+    staging = "{}/.{}.new.{}".format(parent, name, os.getpid())
+    if os.path.exists(staging):
+        rmtree(staging)
+    os.makedirs(staging)
+    stats = collections.Counter()
+    try:
+        for (rel, src) in sorted(files.items()):
+            dst = "{}/{}".format(staging, rel)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            cur = "{}/{}".format(target, rel)
+            if os.path.isfile(cur) and _sameContent(src, cur):
+                os.link(cur, dst)
+                stats["unchanged"] += 1
+            else:
+                _reflinkOrCopy(src, dst)
+                stats["written"] += 1
+        if prepare is not None:
+            prepare(staging)
+        if not os.path.exists(target):
+            os.rename(staging, target)
+        elif _exchange(staging, target):
+            rmtree(staging)
+        else:
+            old = "{}/.{}.old.{}".format(parent, name, os.getpid())
+            os.rename(target, old)
+            os.rename(staging, target)
+            rmtree(old)
+    finally:
+        if os.path.exists(staging):
+            rmtree(staging)
+    caption(
+        0,
+        "\t{} files unchanged, {} written".format(stats["unchanged"], stats["written"]),
+    )
+    return stats
+
+
 def deliverDataset(thisSave, thisDeliver):
     caption(4, "Deliver data set to {}".format(thisDeliver))
-    if os.path.exists(thisDeliver):
-        rmtree(thisDeliver)
-    copytree(thisSave, thisDeliver)
+    deliverTree(treeFiles(thisSave), thisDeliver)
 
 
 def deliverFeatures(thisSave, thisDeliver, newFeatures, deleteFeatures=None):
     caption(4, "Deliver features to {}".format(thisDeliver))
-    if not os.path.exists(thisDeliver):
-        os.makedirs(thisDeliver)
+    files = treeFiles(thisDeliver)
     for feature in newFeatures:
-        tempLoc = "{}/{}.tf".format(thisSave, feature)
-        deliverLoc = "{}/{}.tf".format(thisDeliver, feature)
         caption(0, "\t{}".format(feature))
-        copy(tempLoc, deliverLoc)
+        files["{}.tf".format(feature)] = "{}/{}.tf".format(thisSave, feature)
     if deleteFeatures is not None:
         caption(4, "Delete features from {}".format(thisDeliver))
         for feature in deleteFeatures:
             caption(0, "\t{} ... ".format(feature), newLine=False)
-            deliverLoc = "{}/{}.tf".format(thisDeliver, feature)
-            if os.path.exists(deliverLoc):
-                os.remove(deliverLoc)
+            if files.pop("{}.tf".format(feature), None) is not None:
                 caption(0, "deleted", continuation=True)
             else:
                 caption(0, "was not present", continuation=True)
+    deliverTree(files, thisDeliver)